@@ -0,0 +1,301 @@
+#Standard Library Imports
+import argparse
+import json
+import re
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from metrics import metrics
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_FEED_PORT = 8766
+DEFAULT_HTTP_PORT = 8767
+
+
+def parse_address(address:str, default_port:int=DEFAULT_FEED_PORT) -> tuple:
+    """(host, port) of a "host:port" string"""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return port or DEFAULT_HOST, default_port
+    return host, int(port)
+
+
+class Forwarder(threading.Thread):
+    def __init__(self, engine, address:str, node:str=None, interval:float=1.0):
+        """Thread streaming the state of the boxes of an engine to an aggregator
+
+        The feed is one JSON object per line over TCP. On every connection the node first sends
+        its name and the full state of its boxes, then every `interval` seconds the fields of the
+        states which changed since they were last sent. Only the newest value of a field is kept
+        between batches, so a slow or absent aggregator costs a bounded amount of memory and the
+        engine is never held up. A dropped connection is retried, the full state being sent again.
+
+        Args:
+            engine (Engine): Engine whose events are forwarded
+            address (str): "host:port" of the feed of the aggregator
+            node (str, optional): Name of this node. Defaults to None, meaning the host name.
+            interval (float, optional): Time in seconds between two batches. Defaults to 1.0.
+        """
+        super().__init__(name='forwarder', daemon=True)
+        self.engine = engine
+        self.host, self.port = parse_address(address)
+        self.node = node or socket.gethostname()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}  # box index -> changed fields of its state
+        self.known = {}    # box index -> state of the box as the aggregator has it once the pending fields are sent
+        self.stopped = threading.Event()
+        self.socket = None
+
+
+    def on_event(self, event:dict) -> None:
+        if event['event'] == 'reading':
+            state = event['state']
+        elif event['event'] == 'status':
+            state = {'status': event['status']}
+        else:
+            return
+        with self.lock:
+            known = self.known.setdefault(event['box'], {})
+            changes = {key: value for key, value in state.items() if key not in known or known[key] != value}
+            if changes:
+                known.update(changes)
+                self.pending.setdefault(event['box'], {}).update(changes)
+
+
+    def hello(self) -> bytes:
+        """Full state of the boxes, sent on connecting, call with the lock held"""
+        snapshot = self.engine.snapshot()
+        boxes = [{key: box[key] for key in ('name', 'port', 'address', 'state')} for box in snapshot['boxes']]
+        self.pending.clear()
+        self.known = {i: dict(box['state']) for i, box in enumerate(boxes)}
+        return (json.dumps({'node': self.node, 'boxes': boxes}) + '\n').encode()
+
+
+    def batch(self) -> bytes:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return b''.join((json.dumps({'box': i, 'state': state}) + '\n').encode() for i, state in pending.items())
+
+
+    def run(self) -> None:
+        self.engine.subscribe(self.on_event)
+        delay = 1.
+        while not self.stopped.is_set():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=10.) as self.socket:
+                    with self.lock:
+                        hello = self.hello()
+                    self.socket.sendall(hello)
+                    delay = 1.
+                    while not self.stopped.wait(self.interval):
+                        data = self.batch()
+                        if data:
+                            self.socket.sendall(data)
+            except OSError as e:
+                if not self.stopped.is_set():
+                    print(f'lost the aggregator {self.host}:{self.port}: {e}')
+            self.stopped.wait(delay)
+            delay = min(60., delay*2)
+        self.engine.unsubscribe(self.on_event)
+
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+class Index(object):
+    def __init__(self, max_boxes:int=10000):
+        """Latest state of the boxes of every node, bounded to max_boxes
+
+        Args:
+            max_boxes (int, optional): Boxes kept, the ones not updated for the longest time are dropped first. Defaults to 10000.
+        """
+        self.max_boxes = max_boxes
+        self.lock = threading.Lock()
+        self.boxes = OrderedDict()  # (node, box index) -> box, least recently updated first
+        self.nodes = {}             # node -> {'peer', 'connected', 'last_seen', 'boxes'}
+
+
+    def connect(self, node:str, peer:str, boxes:list) -> None:
+        """A node (re)connected and sent the full state of its boxes"""
+        now = time.time()
+        with self.lock:
+            for key in [key for key in self.boxes if key[0] == node and key[1] >= len(boxes)]:
+                del self.boxes[key]
+            self.nodes[node] = {'peer': peer, 'connected': True, 'last_seen': now, 'boxes': len(boxes)}
+            for i, box in enumerate(boxes):
+                self._put(node, i, dict(box, node=node, box=i, updated=now))
+
+
+    def update(self, node:str, i:int, changes:dict) -> None:
+        now = time.time()
+        with self.lock:
+            box = self.boxes.get((node, i))
+            if box is None:
+                box = {'node': node, 'box': i, 'state': {}}
+            box['state'].update(changes)
+            box['updated'] = now
+            self._put(node, i, box)
+            self.nodes[node]['last_seen'] = now
+
+
+    def _put(self, node:str, i:int, box:dict) -> None:
+        self.boxes[(node, i)] = box
+        self.boxes.move_to_end((node, i))
+        while len(self.boxes) > self.max_boxes:
+            self.boxes.popitem(last=False)
+
+
+    def disconnect(self, node:str) -> None:
+        with self.lock:
+            if node in self.nodes:
+                self.nodes[node]['connected'] = False
+
+
+    def query(self, node:str=None, status:str=None, name:str=None) -> list:
+        """Copies of the boxes matching every given filter, sorted by node and box index
+
+        Args:
+            node (str, optional): Name of the node
+            status (str, optional): Status of the boxes
+            name (str, optional): Regular expression searched in the names of the boxes
+        """
+        pattern = re.compile(name) if name else None
+        with self.lock:
+            boxes = [json.loads(json.dumps(box)) for (n, i), box in self.boxes.items()
+                     if (node is None or n == node)
+                     and (status is None or box['state'].get('status') == status)
+                     and (pattern is None or pattern.search(box.get('name', '')))]
+        return sorted(boxes, key=lambda box: (box['node'], box['box']))
+
+
+    def box(self, node:str, i:int) -> dict:
+        with self.lock:
+            box = self.boxes.get((node, i))
+            if box is None:
+                raise IndexError(f'there is no box {i} on node {node}')
+            return json.loads(json.dumps(box))
+
+
+    def summary(self) -> dict:
+        """Nodes, and number of boxes per status"""
+        with self.lock:
+            statuses = {}
+            for box in self.boxes.values():
+                status = box['state'].get('status', 'unknown')
+                statuses[status] = statuses.get(status, 0) + 1
+            return {'nodes': json.loads(json.dumps(self.nodes)), 'boxes': len(self.boxes), 'statuses': statuses}
+
+
+class FeedHandler(socketserver.StreamRequestHandler):
+    """Reads the feed of one node, see Forwarder"""
+    index = None  # set by serve
+
+    def handle(self) -> None:
+        node = None
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if 'node' in message:
+                    node = message['node']
+                    self.index.connect(node, f'{self.client_address[0]}:{self.client_address[1]}', message['boxes'])
+                elif node is not None:
+                    self.index.update(node, int(message['box']), message['state'])
+                metrics.increment('feed_messages')
+        except (OSError, ValueError, KeyError) as e:
+            print(f'dropped the feed of {node or self.client_address}: {e!r}')
+        finally:
+            if node is not None:
+                self.index.disconnect(node)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """HTTP API of the aggregator, every body is JSON
+
+    GET /summary                   nodes, and number of boxes per status
+    GET /nodes                     nodes with their address, connection and time of their last message
+    GET /boxes?node=&status=&name= latest state of the boxes of every node, optionally filtered
+    GET /boxes/<node>/<i>          latest state of one box
+    """
+    index = None  # set by serve
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_json(self, data, status:int=200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        path = path.rstrip('/')
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        try:
+            if path == '/summary':
+                return self.send_json(self.index.summary())
+            if path == '/nodes':
+                return self.send_json(self.index.summary()['nodes'])
+            if path == '/boxes':
+                return self.send_json(self.index.query(params.get('node'), params.get('status'), params.get('name')))
+            match = re.fullmatch(r'/boxes/([^/]+)/([0-9]+)', path)
+            if match:
+                return self.send_json(self.index.box(match.group(1), int(match.group(2))))
+            self.send_json({'error': f'no route for GET {path}'}, 404)
+        except IndexError as e:
+            self.send_json({'error': str(e)}, 404)
+        except re.error as e:
+            self.send_json({'error': f'bad request: {e!r}'}, 400)
+
+
+def serve(index:Index, host:str=DEFAULT_HOST, feed_port:int=DEFAULT_FEED_PORT, http_port:int=DEFAULT_HTTP_PORT) -> tuple:
+    """Create the feed and HTTP servers of an index, call .serve_forever on both to handle them
+
+    Returns:
+        tuple: (feed server, HTTP server)
+    """
+    feed = socketserver.ThreadingTCPServer((host, feed_port), type('IndexFeedHandler', (FeedHandler,), {'index': index}))
+    feed.daemon_threads = True
+    http = ThreadingHTTPServer((host, http_port), type('IndexQueryHandler', (QueryHandler,), {'index': index}))
+    http.daemon_threads = True
+    return feed, http
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the boxes of several engines into one view')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on, use 0.0.0.0 to accept other machines')
+    parser.add_argument('--feed-port', type=int, default=DEFAULT_FEED_PORT, help='port the engines stream to')
+    parser.add_argument('--http-port', type=int, default=DEFAULT_HTTP_PORT, help='port of the query API')
+    parser.add_argument('--max-boxes', type=int, default=10000, help='boxes kept in memory')
+    args = parser.parse_args()
+
+    index = Index(args.max_boxes)
+    feed, http = serve(index, args.host, args.feed_port, args.http_port)
+    threading.Thread(target=feed.serve_forever, name='feed', daemon=True).start()
+    print(f'feed on {args.host}:{args.feed_port}, queries on http://{args.host}:{args.http_port}')
+    try:
+        http.serve_forever()
+    except KeyboardInterrupt:
+        print('stopping')
+    finally:
+        feed.shutdown()
+        feed.server_close()
+        http.server_close()
+
+
+if __name__ == "__main__":
+    main()
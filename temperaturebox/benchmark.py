@@ -0,0 +1,176 @@
+#Standard Library Imports
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from engine import Engine
+from metrics import metrics
+from simulator import SimulatedBus
+
+
+def make_settings(buses:list, per_bus:int, data_directory:str, step_seconds:float, transport:str='minimalmodbus', poll_threads:int=None) -> dict:
+    """Settings with one box per simulated controller, each running a two step protocol"""
+    boxes = []
+    for bus in buses:
+        for address in bus.devices:
+            boxes.append({
+                'address': address,
+                'name': f'Box {len(boxes) + 1}',
+                'port': bus.port,
+                'protocol': [
+                    {'step': 1, 'temperature': 40., 'time': step_seconds/3600},
+                    {'step': 2, 'temperature': 30., 'time': -1.}],
+                'state': {'status': 'unknown'}})
+    return {
+        'data_directory': data_directory,
+        'read_delta': 0,
+        'sleep': 0.5,
+        'storage': 'binary',
+        'transport': transport,
+        'poll_threads': poll_threads,
+        'boxes': boxes}
+
+
+def run_case(boxes:int, per_bus:int, duration:float, latency:float, drop_rate:float, transport:str='minimalmodbus', poll_threads:int=None) -> dict:
+    """Run the engine against simulated controllers, polling every box as fast as its bus allows
+
+    Returns:
+        dict: Sweep time, step transition error, throughput, CPU and memory use of the case
+    """
+    buses = []
+    remaining = boxes
+    while remaining > 0:
+        buses.append(SimulatedBus(range(1, min(per_bus, remaining) + 1), latency, drop_rate, speedup=60.))
+        remaining -= per_bus
+    for bus in buses:
+        bus.start()
+
+    with tempfile.TemporaryDirectory() as data_directory:
+        step_seconds = duration/2
+        engine = Engine(make_settings(buses, per_bus, data_directory, step_seconds, transport, poll_threads))
+        metrics.enabled = True
+        metrics.reset()
+
+        readings = []  # (box, timestamp)
+        lock = threading.Lock()
+        def listener(event):
+            if event['event'] != 'reading':
+                return
+            state = event['state']
+            with lock:
+                readings.append((event['box'], state['timestamp']))
+        engine.subscribe(listener)
+
+        tracemalloc.start()
+        cpu = time.process_time()
+        start = time.time()
+        for i in range(boxes):
+            engine.start(i, f'box-{i}')
+        thread = threading.Thread(target=engine.scheduler.run, daemon=True)
+        thread.start()
+        time.sleep(duration)
+        wall = time.time() - start
+        cpu = time.process_time() - cpu
+        _, peak_memory = tracemalloc.get_traced_memory()
+        threads = threading.active_count() - len(buses)
+        tracemalloc.stop()
+
+        # how far from its due time each box changed step
+        transitions = []
+        for box in engine.settings['boxes']:
+            state = box['state']
+            if state.get('current_step') == 2:
+                transitions.append(state['step_start_timestamp'] - (state['start_timestamp'] + step_seconds))
+
+        snapshot = metrics.snapshot()
+        engine.close()
+        for bus in buses:
+            bus.stop()
+
+    intervals = {}
+    last = {}
+    for i, stamp in sorted(readings, key=lambda r: r[1]):
+        if i in last:
+            intervals.setdefault(i, []).append(stamp - last[i])
+        last[i] = stamp
+    sweeps = [statistics.mean(v) for v in intervals.values() if v]
+    # the per port histograms, the per box ones also have an address label
+    port_reads = [h for key, h in snapshot['histograms'].items() if key.startswith('read_seconds{') and 'address=' not in key]
+    timeouts = sum(v for k, v in snapshot['counters'].items() if k.startswith('timeouts'))
+
+    return {
+        'boxes': boxes,
+        'buses': len(buses),
+        'duration': wall,
+        'samples': len(readings),
+        'samples_per_second': len(readings)/wall,
+        'sweep_seconds': max(sweeps) if sweeps else None,
+        'step_transition_error_seconds': max((abs(t) for t in transitions), default=None),
+        'step_transitions': len(transitions),
+        'read_p90_seconds': max((h.get('p90', 0) for h in port_reads), default=None),
+        'timeouts': timeouts,
+        'threads': threads,
+        'cpu_fraction': cpu/wall,
+        'peak_memory_bytes': peak_memory}
+
+
+def compare(results:list, baseline:list, tolerance:float) -> list:
+    """Regressions of the throughput against a baseline, as messages"""
+    regressions = []
+    previous = {r['boxes']: r for r in baseline}
+    for result in results:
+        reference = previous.get(result['boxes'])
+        if reference is None:
+            continue
+        if result['samples_per_second'] < reference['samples_per_second']*(1 - tolerance):
+            regressions.append(f"{result['boxes']} boxes: {result['samples_per_second']:.1f} samples/s, baseline {reference['samples_per_second']:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the polling engine against simulated Novus N1050 controllers')
+    parser.add_argument('--boxes', type=int, nargs='+', default=[1, 10, 50, 100], help='numbers of boxes to benchmark')
+    parser.add_argument('--per-bus', type=int, default=10, help='boxes sharing each simulated port')
+    parser.add_argument('--duration', type=float, default=10., help='duration in seconds of each case')
+    parser.add_argument('--latency', type=float, default=0.005, help='response time in seconds of the controllers')
+    parser.add_argument('--drop-rate', type=float, default=0., help='probability that a request gets no reply')
+    parser.add_argument('--transport', choices=['minimalmodbus', 'asyncio'], default='minimalmodbus', help='Modbus transport of the engine')
+    parser.add_argument('--poll-threads', type=int, help='largest number of polling threads, one per port by default')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare the throughput with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput loss against the baseline')
+    args = parser.parse_args()
+
+    if os.name != 'posix':
+        sys.exit('the simulated controllers need pseudo-terminals, run the benchmark on Linux or macOS')
+
+    results = []
+    print(f"{'boxes':>6} {'buses':>6} {'samples/s':>10} {'sweep s':>8} {'step err s':>10} {'read p90 s':>10} {'timeouts':>8} {'threads':>7} {'cpu':>6} {'peak MB':>8}")
+    for boxes in args.boxes:
+        result = run_case(boxes, args.per_bus, args.duration, args.latency, args.drop_rate, args.transport, args.poll_threads)
+        results.append(result)
+        print(f"{result['boxes']:>6} {result['buses']:>6} {result['samples_per_second']:>10.1f} {result['sweep_seconds'] or 0:>8.3f} "
+              f"{result['step_transition_error_seconds'] or 0:>10.3f} {result['read_p90_seconds'] or 0:>10.3f} {result['timeouts']:>8} "
+              f"{result['threads']:>7} {result['cpu_fraction']:>6.1%} {result['peak_memory_bytes']/1e6:>8.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('regression: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+#Standard Library Imports
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from storage import BinaryBackend, COLUMNS, read_records, record_dtype
+
+# numpy is only needed to read the runs back for analysis
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Files kept next to every run file
+META_EXTENSION = '.json'        # metadata of the run, written when it starts and ends
+STEPS_EXTENSION = '.steps'      # "<step> <start timestamp>" lines, appended at every step change
+CACHE_EXTENSION = '.npy'        # columns of a CSV run, parsed once
+AGGREGATES_EXTENSION = '.agg.npy'  # statistics of every step
+
+AGGREGATE_FIELDS = ('step', 'start', 'end', 'count', 'pv_mean', 'pv_min', 'pv_max', 'pv_std', 'sv_mean', 'output_mean')
+
+
+def _write_json(filepath:str, data:dict) -> None:
+    temporary = filepath + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(temporary, filepath)
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise ImportError('numpy is required to read the runs of the catalog')
+
+
+def _fresh(cache:str, *sources:str) -> bool:
+    """Whether a cache file is newer than all its existing sources"""
+    if not os.path.exists(cache):
+        return False
+    mtime = os.path.getmtime(cache)
+    return all(os.path.getmtime(source) <= mtime for source in sources if os.path.exists(source))
+
+
+class RunRecorder(object):
+    def __init__(self):
+        """Writes the metadata and step boundaries of the runs next to their data files, see Run
+
+        The metadata is only rewritten when a run starts and ends, the step boundaries are appended
+        to their own file, so long protocols cost one short line per step.
+        """
+        self.lock = threading.Lock()
+
+
+    def started(self, i:int, box:dict, storage:str) -> None:
+        """Record the start of the run of box i, with its connection and protocol"""
+        state = box['state']
+        meta = {
+            'box': i,
+            'name': box.get('name', f'Box {i+1}'),
+            'port': box['port'],
+            'address': box['address'],
+            'protocol': box['protocol'],
+            'basename': state['basename'],
+            'filepath': state['filepath'],
+            'storage': storage,
+            'start_timestamp': state['start_timestamp'],
+            'status': 'running'}
+        with self.lock:
+            _write_json(state['filepath'] + META_EXTENSION, meta)
+            # a run starting again in the same file replaces the steps of the previous one
+            with open(state['filepath'] + STEPS_EXTENSION, 'w') as f:
+                f.write(f"{state['current_step']} {state['step_start_timestamp']!r}\n")
+
+
+    def stepped(self, box:dict) -> None:
+        state = box['state']
+        with self.lock, open(state['filepath'] + STEPS_EXTENSION, 'a') as f:
+            f.write(f"{state['current_step']} {state['step_start_timestamp']!r}\n")
+
+
+    def ended(self, box:dict, status:str) -> None:
+        """Record that a run is done or stopped"""
+        filepath = box['state'].get('filepath')
+        if filepath is None:
+            return
+        with self.lock:
+            try:
+                with open(filepath + META_EXTENSION, 'r') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return
+            meta.update(status=status, end_timestamp=time.time())
+            _write_json(filepath + META_EXTENSION, meta)
+
+
+class Run(object):
+    def __init__(self, meta:dict, metapath:str):
+        """A run of the catalog, reading its data file through numpy
+
+        Args:
+            meta (dict): Metadata of the run, as written by RunRecorder
+            metapath (str): Path of the metadata file
+        """
+        self.meta = meta
+        self.filepath = metapath[:-len(META_EXTENSION)]
+
+
+    def __repr__(self) -> str:
+        return f"Run({self.meta['basename']!r}, box={self.meta['box']}, start={datetime.fromtimestamp(self.meta['start_timestamp']):%Y-%m-%d %H:%M})"
+
+
+    def records(self):
+        """All the datapoints of the run as a structured array, memory-mapped
+
+        Binary runs are mapped directly. CSV runs are parsed once into a .npy cache next to them,
+        which is mapped from then on and parsed again only when the CSV file changes. The columns
+        of a CSV file are those of its header, the output of the files predating it being NaN.
+
+        Returns:
+            numpy.ndarray: Structured array with the fields of storage.COLUMNS
+        """
+        _require_numpy()
+        if self.filepath.endswith(BinaryBackend.extension):
+            return read_records(self.filepath)
+        cache = self.filepath + CACHE_EXTENSION
+        if not _fresh(cache, self.filepath):
+            with open(self.filepath, 'r') as f:
+                names = [name.strip() for name in f.readline().split(',')]
+            # rows with more values than the header, from a resumed run, are read up to the header
+            columns = np.loadtxt(self.filepath, delimiter=',', skiprows=1, ndmin=2, dtype='<f8', usecols=range(len(names)))
+            records = np.zeros(len(columns), dtype=record_dtype())
+            for column in COLUMNS:
+                records[column] = columns[:, names.index(column)] if column in names else np.nan
+            np.save(cache, records)
+        return np.load(cache, mmap_mode='r')
+
+
+    def window(self, start:float=None, end:float=None):
+        """Datapoints with a timestamp in [start, end), found by bisecting the sorted timestamps
+
+        Args:
+            start (float, optional): First timestamp. Defaults to None, from the start of the run.
+            end (float, optional): Timestamp after the last one. Defaults to None, to the end of the run.
+        """
+        records = self.records()
+        timestamps = records['timestamp']
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, 'left'))
+        last = len(records) if end is None else int(np.searchsorted(timestamps, end, 'left'))
+        return records[first:last]
+
+
+    def steps(self):
+        """Start and end timestamps of every step, the last one ending with the run
+
+        Returns:
+            numpy.ndarray: Structured array with the step, start and end fields
+        """
+        _require_numpy()
+        boundaries = {}
+        try:
+            with open(self.filepath + STEPS_EXTENSION, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        # a step restarted after a crash keeps its last start
+                        boundaries[int(fields[0])] = float(fields[1])
+        except OSError:
+            pass
+        steps = np.zeros(len(boundaries), dtype=[('step', '<i4'), ('start', '<f8'), ('end', '<f8')])
+        ordered = sorted(boundaries.items(), key=lambda item: item[1])
+        steps['step'] = [step for step, start in ordered]
+        steps['start'] = [start for step, start in ordered]
+        steps['end'][:-1] = steps['start'][1:]
+        if len(steps):
+            steps['end'][-1] = self.meta.get('end_timestamp', np.inf)
+        return steps
+
+
+    def step(self, step:int):
+        """Datapoints of one step of the run"""
+        steps = self.steps()
+        match = steps[steps['step'] == step]
+        if not len(match):
+            raise KeyError(f"run {self.meta['basename']} has no step {step}")
+        return self.window(match['start'][-1], match['end'][-1])
+
+
+    def aggregates(self):
+        """Statistics of the datapoints of every step, computed in one pass and cached next to the run
+
+        Returns:
+            numpy.ndarray: Structured array with the AGGREGATE_FIELDS, one row per step
+        """
+        _require_numpy()
+        cache = self.filepath + AGGREGATES_EXTENSION
+        if _fresh(cache, self.filepath, self.filepath + STEPS_EXTENSION, self.filepath + META_EXTENSION):
+            return np.load(cache)
+
+        steps = self.steps()
+        records = self.records()
+        timestamps = records['timestamp']
+        starts = np.searchsorted(timestamps, steps['start'], 'left')
+        ends = np.searchsorted(timestamps, steps['end'], 'left')
+        counts = ends - starts
+
+        aggregates = np.zeros(len(steps), dtype=[(f, '<i4' if f in ('step', 'count') else '<f8') for f in AGGREGATE_FIELDS])
+        aggregates['step'] = steps['step']
+        aggregates['start'] = steps['start']
+        aggregates['end'] = steps['end']
+        aggregates['count'] = counts
+        for field in AGGREGATE_FIELDS[4:]:
+            aggregates[field] = np.nan
+
+        # sums over the steps as differences of cumulative sums, extrema over the non empty steps
+        def sums(values):
+            cumulative = np.concatenate(([0.], np.cumsum(values, dtype='<f8')))
+            return cumulative[ends] - cumulative[starts]
+        filled = counts > 0
+        if filled.any():
+            pv = np.asarray(records['pv'], dtype='<f8')
+            n = counts[filled]
+            mean = sums(pv)[filled]/n
+            aggregates['pv_mean'][filled] = mean
+            aggregates['pv_std'][filled] = np.sqrt(np.maximum(sums(pv*pv)[filled]/n - mean*mean, 0.))
+            aggregates['sv_mean'][filled] = sums(records['sv'])[filled]/n
+            aggregates['output_mean'][filled] = sums(records['output'])[filled]/n
+            # the steps follow each other, so each non empty step runs until the next non empty one starts
+            bounds = starts[filled]
+            last = ends[filled][-1]
+            aggregates['pv_min'][filled] = np.minimum.reduceat(pv[:last], bounds)
+            aggregates['pv_max'][filled] = np.maximum.reduceat(pv[:last], bounds)
+
+        # a running run is computed again on the next call
+        if self.meta.get('status') != 'running':
+            np.save(cache, aggregates)
+        return aggregates
+
+
+class Catalog(object):
+    def __init__(self, directory:str):
+        """Runs recorded in a data directory
+
+        Args:
+            directory (str): Data directory, as in the data_directory setting
+        """
+        self.directory = directory
+
+
+    def runs(self, box:int=None, name:str=None, port:str=None, since:float=None, until:float=None, status:str=None) -> list:
+        """Runs matching every given filter, oldest first
+
+        Args:
+            box (int, optional): Box index, 0 for the first box
+            name (str, optional): Name of the box
+            port (str, optional): Port of the box
+            since (float, optional): Runs started at or after this timestamp
+            until (float, optional): Runs started before this timestamp
+            status (str, optional): 'running', 'done' or 'stopped'
+        """
+        runs = []
+        for metapath in glob.glob(os.path.join(glob.escape(self.directory), '*' + META_EXTENSION)):
+            try:
+                with open(metapath, 'r') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not isinstance(meta, dict) or 'start_timestamp' not in meta:
+                continue
+            if ((box is None or meta['box'] == box)
+                    and (name is None or meta['name'] == name)
+                    and (port is None or meta['port'] == port)
+                    and (since is None or meta['start_timestamp'] >= since)
+                    and (until is None or meta['start_timestamp'] < until)
+                    and (status is None or meta['status'] == status)):
+                runs.append(Run(meta, metapath))
+        return sorted(runs, key=lambda run: run.meta['start_timestamp'])
+
+
+    def run(self, basename:str) -> Run:
+        """Newest run with a basename"""
+        runs = [run for run in self.runs() if run.meta['basename'] == basename]
+        if not runs:
+            raise KeyError(f'no run named {basename} in {self.directory}')
+        return runs[-1]
+
+
+def _timestamp(date:str) -> float:
+    return datetime.fromisoformat(date).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the runs recorded in a data directory')
+    parser.add_argument('--dir', default='./data', help='data directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    listing = subparsers.add_parser('list', help='list the runs')
+    listing.add_argument('--box', type=int, help='box index, 0 for the first box')
+    listing.add_argument('--name', help='name of the box')
+    listing.add_argument('--since', help='first start date, as 2024-05-01 or 2024-05-01T12:00')
+    listing.add_argument('--until', help='last start date, excluded')
+    listing.add_argument('--status', choices=('running', 'done', 'stopped'))
+    steps = subparsers.add_parser('steps', help='statistics of every step of a run')
+    steps.add_argument('run', help='basename of the run')
+    export = subparsers.add_parser('export', help='save datapoints of a run as a .npy array')
+    export.add_argument('run', help='basename of the run')
+    export.add_argument('output', help='.npy file')
+    export.add_argument('--step', type=int, help='only this step')
+    subparsers.add_parser('index', help='precompute the step statistics of every finished run')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.dir)
+    if args.command == 'list':
+        runs = catalog.runs(box=args.box, name=args.name, status=args.status,
+            since=_timestamp(args.since) if args.since else None, until=_timestamp(args.until) if args.until else None)
+        for run in runs:
+            meta = run.meta
+            print(f"{datetime.fromtimestamp(meta['start_timestamp']):%Y-%m-%d %H:%M}  {meta['name']:<10} {meta['port']:<12} {meta['address']:>3}  {meta['status']:<8} {meta['basename']}")
+    elif args.command == 'steps':
+        print(f"{'step':>5} {'hours':>8} {'count':>7} {'pv mean':>8} {'pv min':>8} {'pv max':>8} {'pv std':>7} {'sv mean':>8} {'out %':>6}")
+        for row in catalog.run(args.run).aggregates():
+            hours = (row['end'] - row['start'])/3600
+            print(f"{row['step']:>5} {hours:>8.2f} {row['count']:>7} {row['pv_mean']:>8.2f} {row['pv_min']:>8.2f} {row['pv_max']:>8.2f} {row['pv_std']:>7.3f} {row['sv_mean']:>8.2f} {row['output_mean']:>6.1f}")
+    elif args.command == 'export':
+        run = catalog.run(args.run)
+        records = run.step(args.step) if args.step is not None else run.records()
+        np.save(args.output, records)
+        print(f'saved {len(records)} datapoints to {args.output}')
+    elif args.command == 'index':
+        runs = [run for run in catalog.runs() if run.meta['status'] != 'running']
+        for run in runs:
+            run.aggregates()
+        print(f'indexed {len(runs)} runs')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#Standard Library Imports
+import threading
+import time
+from contextlib import contextmanager
+
+# Imports for connecting to Novus
+import serial
+import minimalmodbus
+
+from metrics import metrics
+
+
+class PortBackoffError(serial.SerialException):
+    """Raised when a port or an address is waiting out its reconnect backoff
+
+    Attributes:
+        retry_at (float): Timestamp at which the backoff ends
+    """
+    def __init__(self, message:str, retry_at:float):
+        super().__init__(message)
+        self.retry_at = retry_at
+
+
+class _Backoff(object):
+    def __init__(self, initial:float, maximum:float, tolerance:int=0):
+        """Exponential backoff tracker for a port or a single address on a port
+
+        Args:
+            initial (float): Delay in seconds after the first failure counted
+            maximum (float): Upper bound of the delay in seconds
+            tolerance (int, optional): Failures in a row retried right away before backing off. Defaults to 0.
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.failures = 0
+        self.delay = 0.
+        self.retry_at = 0.
+
+    def ready(self) -> bool:
+        return time.monotonic() >= self.retry_at
+
+    def failed(self) -> None:
+        self.failures += 1
+        if self.failures <= self.tolerance:
+            return
+        self.delay = min(self.maximum, self.delay*2 if self.delay else self.initial)
+        self.retry_at = time.monotonic() + self.delay
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.delay = 0.
+        self.retry_at = 0.
+
+
+class ConnectionPool(object):
+    def __init__(self, baudrate:int=9600, timeout:float=0.5, backoff_initial:float=1.0, backoff_max:float=60.0):
+        """Pool of open Modbus connections to the Novus controllers
+
+        Every port is opened once and kept open across polls. All the addresses on the same
+        RS485 bus share the single serial handle of their port, and a lock per port makes sure
+        only one transaction is on the bus at a time.
+
+        A serial failure closes the port and backs off before reopening it. A controller that
+        does not answer only backs off its own address, so a dead box does not stall the bus,
+        and only from its second failure in a row, a single dropped reply being retried right away.
+
+        Args:
+            baudrate (int, optional): Baudrate of the controllers. Defaults to 9600.
+            timeout (float, optional): Serial read timeout in seconds. Defaults to 0.5.
+            backoff_initial (float, optional): Delay in seconds before the first reconnect. Defaults to 1.0.
+            backoff_max (float, optional): Maximum delay in seconds between reconnects. Defaults to 60.0.
+        """
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._serials = {}      # port -> serial.Serial
+        self._port_locks = {}   # port -> threading.RLock
+        self._instruments = {}  # (port, address) -> minimalmodbus.Instrument
+        self._backoffs = {}     # port or (port, address) -> _Backoff
+
+
+    def _backoff(self, key) -> _Backoff:
+        if key not in self._backoffs:
+            # the keys of the addresses are (port, address) tuples
+            self._backoffs[key] = _Backoff(self.backoff_initial, self.backoff_max, 1 if isinstance(key, tuple) else 0)
+        return self._backoffs[key]
+
+
+    def port_lock(self, port:str) -> threading.RLock:
+        """Lock serializing the transactions on a port
+
+        Args:
+            port (str): Port name
+
+        Returns:
+            threading.RLock: The lock shared by every address on the port
+        """
+        with self._lock:
+            if port not in self._port_locks:
+                self._port_locks[port] = threading.RLock()
+            return self._port_locks[port]
+
+
+    def _open_serial(self, port:str) -> serial.Serial:
+        handle = self._serials.get(port)
+        if handle is not None and handle.is_open:
+            return handle
+        handle = serial.Serial(
+            port,
+            baudrate=self.baudrate,
+            parity=serial.PARITY_NONE,
+            bytesize=serial.EIGHTBITS,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=self.timeout)
+        metrics.increment('port_opens', port=port)
+        self._serials[port] = handle
+        # instruments bound to a previous handle of this port are stale
+        for key in [key for key in self._instruments if key[0] == port]:
+            del self._instruments[key]
+        return handle
+
+
+    def get_instrument(self, port:str, address:int) -> minimalmodbus.Instrument:
+        """Get the pooled instrument for a port and address, opening the port if needed
+
+        The caller should hold the port lock while using the instrument, see .connection
+
+        Args:
+            port (str): Port name
+            address (int): Modbus address of the controller
+
+        Returns:
+            minimalmodbus.Instrument: Instrument sharing the open serial handle of the port
+        """
+        address = int(address)
+        with self.port_lock(port):
+            handle = self._open_serial(port)
+            instrument = self._instruments.get((port, address))
+            if instrument is None:
+                instrument = minimalmodbus.Instrument(handle, address)
+                instrument.close_port_after_each_call = False
+                self._instruments[(port, address)] = instrument
+            return instrument
+
+
+    @contextmanager
+    def connection(self, port:str, address:int):
+        """Context manager holding the bus of a port and yielding the instrument for an address
+
+        Raises PortBackoffError without touching the bus while the port or the address is backing off.
+
+        Args:
+            port (str): Port name
+            address (int): Modbus address of the controller
+
+        Yields:
+            minimalmodbus.Instrument: Instrument ready for reading and writing
+        """
+        address = int(address)
+        with self.port_lock(port):
+            self._check_backoff(port, address)
+            try:
+                instrument = self.get_instrument(port, address)
+                yield instrument
+            except (serial.SerialException, OSError) as e:
+                self._outcome(port, address, e)
+                raise
+            else:
+                self._outcome(port, address)
+
+
+    def _check_backoff(self, port:str, address:int) -> None:
+        """Raise PortBackoffError while the port or the address is backing off, call with the port lock held"""
+        port_backoff = self._backoff(port)
+        address_backoff = self._backoff((port, address))
+        if not port_backoff.ready():
+            metrics.increment('backoff_skips', port=port)
+            wait = port_backoff.retry_at - time.monotonic()
+            raise PortBackoffError(f'port {port} is reconnecting, retry in {wait:.1f}s', time.time() + wait)
+        if not address_backoff.ready():
+            metrics.increment('backoff_skips', port=port, address=address)
+            wait = address_backoff.retry_at - time.monotonic()
+            raise PortBackoffError(f'address {address} on port {port} is not answering, retry in {wait:.1f}s', time.time() + wait)
+
+
+    def _outcome(self, port:str, address:int, error:Exception=None) -> None:
+        """Update the backoffs after a transaction, which failed if error is given, call with the port lock held"""
+        if error is None:
+            self._backoff(port).succeeded()
+            self._backoff((port, address)).succeeded()
+        elif isinstance(error, minimalmodbus.ModbusException):
+            # the controller did not answer properly, the bus itself is fine
+            self._backoff((port, address)).failed()
+            metrics.increment('timeouts' if isinstance(error, minimalmodbus.NoResponseError) else 'modbus_errors', port=port, address=address)
+        elif isinstance(error, (serial.SerialException, OSError)):
+            # the port itself is broken, drop the handle and reopen it later
+            metrics.increment('serial_errors', port=port)
+            self._close_port(port)
+            self._backoff(port).failed()
+
+
+    def _close_port(self, port:str) -> None:
+        handle = self._serials.pop(port, None)
+        for key in [key for key in self._instruments if key[0] == port]:
+            del self._instruments[key]
+        if handle is not None:
+            try:
+                handle.close()
+            except (serial.SerialException, OSError):
+                pass
+
+
+    def open_ports(self) -> set:
+        """Ports currently held open by the pool"""
+        return {port for port, handle in list(self._serials.items()) if handle.is_open}
+
+
+    def close(self, port:str=None) -> None:
+        """Close one port, or every port of the pool
+
+        Args:
+            port (str, optional): Port to close. Defaults to None, closing all the ports.
+        """
+        ports = [port] if port is not None else list(self._serials)
+        for p in ports:
+            with self.port_lock(p):
+                self._close_port(p)
@@ -0,0 +1,201 @@
+#Standard Library Imports
+import argparse
+import json
+import queue
+import re
+import signal
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from engine import Engine
+from metrics import metrics
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+def reading_dict(reading) -> dict:
+    return asdict(reading)
+
+
+def found_list(found:list) -> list:
+    """JSON friendly version of the result of Engine.scan"""
+    return [dict(port=port, address=address, **asdict(reading)) for port, address, reading in found]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP API of the engine, every body is JSON
+
+    GET    /settings                  settings and state of every box, and the available ports
+    GET    /boxes/<i>                 settings and state of one box
+    GET    /events                    stream of engine events, one JSON object per line
+    POST   /boxes/<i>/check           read a box once
+    POST   /boxes/<i>/start           start the protocol, {"basename": name of the data file}
+    POST   /boxes/<i>/stop            stop the protocol
+    POST   /boxes/<i>/steps           add a step, {"temperature": C, "time": h}
+    PUT    /boxes/<i>/protocol        replace the protocol, {"protocol": [{"temperature": C, "time": h}, ...]}, see protocol.normalize
+    DELETE /boxes/<i>/protocol        clear the protocol
+    POST   /boxes/<i>/connection      change {"port": port, "address": address}
+    POST   /scan                      find the controllers on every port
+    POST   /boxes                     add boxes for controllers found by a scan, {"found": [...]}
+    GET    /metrics                   latency histograms, counters and gauges of the engine
+    POST   /metrics                   {"enabled": true/false} switches the instrumentation, {"reset": true} clears it
+    """
+    engine = None  # set by serve
+    heartbeat = 15.  # seconds between keep-alive lines on the event stream
+    streams = set()  # queues of the open event streams
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_json(self, data, status:int=200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+
+    def dispatch(self, method:str) -> None:
+        engine = self.engine
+        path = self.path.split('?')[0].rstrip('/')
+        try:
+            match = re.fullmatch(r'/boxes/([0-9]+)(/\w+)?', path)
+            i, action = (int(match.group(1)), match.group(2) or '') if match else (None, None)
+
+            if method == 'GET' and path == '/settings':
+                return self.send_json(engine.snapshot())
+            if method == 'GET' and path == '/events':
+                return self.stream_events()
+            if method == 'GET' and path == '/metrics':
+                return self.send_json(metrics.snapshot())
+            if method == 'POST' and path == '/metrics':
+                body = self.read_json()
+                if 'enabled' in body:
+                    metrics.enabled = bool(body['enabled'])
+                if body.get('reset'):
+                    metrics.reset()
+                return self.send_json({'enabled': metrics.enabled})
+            if method == 'GET' and match and action == '':
+                engine.box(i)
+                return self.send_json(engine.snapshot()['boxes'][i])
+            if method == 'POST' and path == '/scan':
+                return self.send_json(found_list(engine.scan()))
+            if method == 'POST' and path == '/boxes':
+                found = [(f['port'], int(f['address']), None) for f in self.read_json()['found']]
+                return self.send_json(engine.add_boxes(found))
+
+            if match and (method, action) == ('POST', '/check'):
+                return self.send_json(reading_dict(engine.check(i)))
+            if match and (method, action) == ('POST', '/start'):
+                engine.start(i, self.read_json()['basename'])
+                return self.send_json({})
+            if match and (method, action) == ('POST', '/stop'):
+                engine.stop(i)
+                return self.send_json({})
+            if match and (method, action) == ('POST', '/steps'):
+                body = self.read_json()
+                return self.send_json(engine.add_step(i, body['temperature'], body['time']))
+            if match and (method, action) == ('PUT', '/protocol'):
+                return self.send_json(engine.set_protocol(i, self.read_json()['protocol']))
+            if match and (method, action) == ('DELETE', '/protocol'):
+                return self.send_json(engine.clear_protocol(i))
+            if match and (method, action) == ('POST', '/connection'):
+                body = self.read_json()
+                engine.set_connection(i, body.get('port'), body.get('address'))
+                return self.send_json({})
+
+            self.send_json({'error': f'no route for {method} {path}'}, 404)
+        except IndexError as e:
+            self.send_json({'error': str(e)}, 404)
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json({'error': f'bad request: {e!r}'}, 400)
+        except Exception as e:
+            self.send_json({'error': str(e)}, 500)
+
+
+    def stream_events(self) -> None:
+        events = queue.Queue(maxsize=1000)
+        def enqueue(event):
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass  # a client too slow to keep up misses events rather than stalling the engine
+        self.engine.subscribe(enqueue)
+        self.streams.add(events)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            while True:
+                try:
+                    line = json.dumps(events.get(timeout=self.heartbeat))
+                except queue.Empty:
+                    line = ''
+                self.wfile.write(line.encode() + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.streams.discard(events)
+            self.engine.unsubscribe(enqueue)
+            self.close_connection = True
+
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+
+def serve(engine:Engine, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT) -> ThreadingHTTPServer:
+    """Create the HTTP server of the API of an engine, call .serve_forever on it to handle requests"""
+    handler = type('EngineHandler', (Handler,), {'engine': engine})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    metrics.gauge('event_stream_queue', lambda: max((q.qsize() for q in list(Handler.streams)), default=0))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the temperature boxes without a GUI, controlled through an HTTP API')
+    parser.add_argument('--settings', default='settings.json', help='settings file, saved back on exit')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on, use 0.0.0.0 to accept other machines')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    args = parser.parse_args()
+
+    engine = Engine.from_file(args.settings)
+    server = serve(engine, args.host, args.port)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    engine.start_thread()
+    print(f'serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('stopping')
+    finally:
+        server.server_close()
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()
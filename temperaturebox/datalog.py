@@ -0,0 +1,278 @@
+#Standard Library Imports
+import os
+import threading
+import time
+
+from storage import get_backend, COLUMNS
+
+
+class RunWriter(object):
+    def __init__(self, filepath:str, flush_rows:int, flush_seconds:float, fsync:bool, backend=None):
+        """Long lived buffered writer of one run file
+
+        A record torn by a crash at the end of an existing file is cut off before appending,
+        so the records of a resumed run stay aligned, and the columns of the file are kept in .columns.
+
+        Args:
+            filepath (str): Path of the run file, records are appended to it
+            flush_rows (int): Flush once this many records are buffered
+            flush_seconds (float): Flush when a record comes in this many seconds after the previous flush
+            fsync (bool): Force the data to disk on every flush
+            backend (optional): Storage backend of the file, telling where its last complete record ends. Defaults to None, appending as is.
+        """
+        self.filepath = filepath
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.columns = COLUMNS
+        if backend is not None and os.path.exists(filepath):
+            with open(filepath, 'r+b') as f:
+                size = backend.complete_size(f)
+                if size < f.seek(0, os.SEEK_END):
+                    f.truncate(size)
+                self.columns = backend.columns(f)
+        self.file = open(filepath, 'ab', buffering=64*1024)
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+
+    def write(self, data:bytes) -> None:
+        with self.lock:
+            self.file.write(data)
+            self.rows += 1
+            if self.rows >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+                self._flush()
+
+
+    def _flush(self) -> None:
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self._flush()
+
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self._flush()
+                self.file.close()
+
+
+class SwingingDoor(object):
+    def __init__(self, deviation:float, max_gap:float):
+        """Swinging door compression of the datapoints of one run, on the PV
+
+        A datapoint is only stored when the line from the last stored point to the newest one would
+        pass further than `deviation` from one of the points in between. The point before is then
+        stored, so the stored points interpolate the PV within the deviation. A change of the
+        set value is always stored with the point before it, and no two stored points are further
+        apart than max_gap, provided the datapoints themselves are.
+
+        Args:
+            deviation (float): Largest error in C of the PV interpolated between the stored points
+            max_gap (float): Largest time in seconds between two stored points
+        """
+        self.deviation = deviation
+        self.max_gap = max_gap
+        self.archived = None  # last stored datapoint
+        self.held = None      # last datapoint offered, stored if the next one breaks the door
+        self.upper = float('inf')   # smallest slope of the upper side of the door
+        self.lower = float('-inf')  # largest slope of the lower side of the door
+
+
+    def open_door(self, point:dict) -> None:
+        self.upper = float('inf')
+        self.lower = float('-inf')
+        self.swing(point)
+
+
+    def swing(self, point:dict) -> bool:
+        """Narrow the door to a new point, False if the line to the point leaves the door"""
+        dt = point['timestamp'] - self.archived['timestamp']
+        if dt <= 0:
+            return True
+        # the line from the stored point to this one stays within the deviation of the points before
+        if not self.lower <= (point['pv'] - self.archived['pv'])/dt <= self.upper:
+            return False
+        self.upper = min(self.upper, (point['pv'] + self.deviation - self.archived['pv'])/dt)
+        self.lower = max(self.lower, (point['pv'] - self.deviation - self.archived['pv'])/dt)
+        return self.lower <= self.upper
+
+
+    def archive(self, point:dict) -> dict:
+        self.archived = point
+        self.held = None
+        return point
+
+
+    def offer(self, state:dict) -> list:
+        """Offer a datapoint
+
+        Args:
+            state (dict): State of the box, with the timestamp, pv and sv keys
+
+        Returns:
+            list: Datapoints to store, oldest first
+        """
+        point = dict(state)
+        if self.archived is None:
+            return [self.archive(point)]
+        stored = []
+        if self.held is not None:
+            if point['sv'] != self.archived['sv'] or point['sv'] != self.held['sv']:
+                # keep the edges of the steps
+                stored.append(self.archive(self.held))
+                stored.append(self.archive(point))
+                return stored
+            if point['timestamp'] - self.archived['timestamp'] > self.max_gap:
+                stored.append(self.archive(self.held))
+                self.open_door(point)
+            elif not self.swing(point):
+                stored.append(self.archive(self.held))
+                self.open_door(point)
+        elif point['sv'] != self.archived['sv'] or point['timestamp'] - self.archived['timestamp'] > self.max_gap:
+            return [self.archive(point)]
+        else:
+            self.open_door(point)
+        self.held = point
+        return stored
+
+
+    def flush(self) -> list:
+        """The datapoint held back, to store when the run ends"""
+        if self.held is None:
+            return []
+        return [self.archive(self.held)]
+
+
+class DataLogger(object):
+    def __init__(self, backend=None, flush_rows:int=20, flush_seconds:float=300., fsync:bool=False, deadband:float=0., max_gap:float=600.):
+        """Logs the datapoints of the runs, keeping one buffered writer open per run file
+
+        Writers are opened on the first record written to a file and stay open until .close,
+        which should be called when a run stops or is done and when the application exits.
+        Once closed for every file, the logger refuses any further record.
+
+        With a deadband, the datapoints are compressed with a SwingingDoor per file, only the
+        points needed to draw the PV within the deadband being stored.
+
+        Args:
+            backend (optional): Storage backend encoding the records, see storage.py. Defaults to None, meaning CSV.
+            flush_rows (int, optional): Flush a file once this many records are buffered. Defaults to 20.
+            flush_seconds (float, optional): Flush a file when a record comes in this long after its last flush. Defaults to 300.
+            fsync (bool, optional): Force the data to disk on every flush, slower but safer on network shares. Defaults to False.
+            deadband (float, optional): Largest error in C of the PV interpolated between the stored points. Defaults to 0, storing every datapoint.
+            max_gap (float, optional): Largest time in seconds between two stored points when compressing. Defaults to 600.
+        """
+        self.backend = backend if backend is not None else get_backend('csv')
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.deadband = deadband
+        self.max_gap = max_gap
+        self.lock = threading.Lock()
+        self.writers = {}  # filepath -> RunWriter
+        self.doors = {}    # filepath -> SwingingDoor, when compressing
+        self.closed = False
+
+
+    @classmethod
+    def from_settings(cls, settings:dict) -> 'DataLogger':
+        """Create the logger from the optional "storage", "log_flush_rows", "log_flush_seconds", "log_fsync", "log_deadband" and "log_max_gap" settings"""
+        return cls(
+            backend=get_backend(settings.get('storage', 'csv')),
+            flush_rows=settings.get('log_flush_rows', 20),
+            flush_seconds=settings.get('log_flush_seconds', 300.),
+            fsync=settings.get('log_fsync', False),
+            deadband=settings.get('log_deadband', 0.),
+            max_gap=settings.get('log_max_gap', 600.))
+
+
+    def writer(self, filepath:str) -> RunWriter:
+        with self.lock:
+            if self.closed:
+                raise ValueError(f'the data logger is closed, {filepath} was not written')
+            writer = self.writers.get(filepath)
+            if writer is None:
+                writer = self.writers[filepath] = RunWriter(filepath, self.flush_rows, self.flush_seconds, self.fsync, self.backend)
+            return writer
+
+
+    def filepath(self, directory:str, basename:str) -> str:
+        """Path of a run file with the extension of the backend"""
+        return os.path.join(directory, basename + self.backend.extension)
+
+
+    def write_header(self, filepath:str) -> None:
+        """Write the header of a run file, unless the file already has data
+
+        Args:
+            filepath (str): Path of the run file
+        """
+        writer = self.writer(filepath)
+        with writer.lock:
+            if writer.file.tell() > 0:
+                return
+        writer.write(self.backend.header())
+
+
+    def write_datapoint(self, filepath:str, state:dict) -> None:
+        """Append a datapoint to a run file
+
+        Args:
+            filepath (str): Path of the run file
+            state (dict): State of the box, with the timestamp, time_elapsed, pv, sv and output keys
+        """
+        if self.deadband <= 0:
+            writer = self.writer(filepath)
+            writer.write(self.backend.encode(state, writer.columns))
+            return
+        with self.lock:
+            door = self.doors.get(filepath)
+            if door is None:
+                door = self.doors[filepath] = SwingingDoor(self.deadband, self.max_gap)
+        writer = self.writer(filepath)
+        for point in door.offer(state):
+            writer.write(self.backend.encode(point, writer.columns))
+
+
+    def flush(self, filepath:str=None) -> None:
+        """Flush one run file, or all of them
+
+        Args:
+            filepath (str, optional): Path of the run file. Defaults to None, flushing every file.
+        """
+        with self.lock:
+            writers = list(self.writers.values()) if filepath is None else [self.writers.get(filepath)]
+        for writer in writers:
+            if writer is not None:
+                writer.flush()
+
+
+    def close(self, filepath:str=None) -> None:
+        """Flush and close one run file, or all of them
+
+        Args:
+            filepath (str, optional): Path of the run file. Defaults to None, closing every file and the logger.
+        """
+        with self.lock:
+            if filepath is None:
+                self.closed = True
+            filepaths = list(self.writers) if filepath is None else [filepath]
+            closing = [(self.writers.pop(f, None), self.doors.pop(f, None)) for f in filepaths]
+        for writer, door in closing:
+            if writer is None:
+                continue
+            # the last datapoint of a compressed run
+            if door is not None:
+                for point in door.flush():
+                    writer.write(self.backend.encode(point, writer.columns))
+            writer.close()
@@ -0,0 +1,137 @@
+#Standard Library Imports
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# Imports for connecting to Novus
+import serial
+import minimalmodbus
+
+from connection import ConnectionPool
+import novus
+from ports import serial_ports
+
+
+ADDRESSES = range(1, 25)
+
+
+def probe_address(pool:ConnectionPool, port:str, address:int, timeout:float=0.1) -> novus.Reading:
+    """Try to read a controller, with a short timeout and ignoring the backoff of the pool
+
+    Args:
+        pool (ConnectionPool): Pool holding the ports
+        port (str): Port name
+        address (int): Modbus address to try
+        timeout (float, optional): Time in seconds to wait for an answer. Defaults to 0.1.
+
+    Returns:
+        novus.Reading: The reading of the controller, None if nothing answered
+    """
+    with pool.port_lock(port):
+        instrument = pool.get_instrument(port, address)
+        previous_timeout = instrument.serial.timeout
+        instrument.serial.timeout = timeout
+        try:
+            return novus.decode_block(instrument.read_registers(novus.BLOCK_START, novus.BLOCK_COUNT))
+        except minimalmodbus.ModbusException:
+            return None
+        finally:
+            instrument.serial.timeout = previous_timeout
+
+
+def scan_port(pool:ConnectionPool, port:str, addresses=ADDRESSES, timeout:float=0.1) -> list:
+    """Find the controllers on one bus, trying the addresses one after the other
+
+    Returns:
+        list: (port, address, reading) for every address which answered
+    """
+    found = []
+    for address in addresses:
+        try:
+            reading = probe_address(pool, port, address, timeout)
+        except (serial.SerialException, OSError) as e:
+            print(f'could not scan port {port}: {e}')
+            pool.close(port)
+            break
+        if reading is not None:
+            found.append((port, address, reading))
+    return found
+
+
+def scan(pool:ConnectionPool, ports:list=None, addresses=ADDRESSES, timeout:float=0.1) -> list:
+    """Find the controllers on every bus, the ports are scanned concurrently
+
+    Args:
+        pool (ConnectionPool): Pool holding the ports
+        ports (list, optional): Ports to scan. Defaults to None, scanning every available port.
+        addresses (optional): Addresses to try on each port. Defaults to ADDRESSES, 1 to 24.
+        timeout (float, optional): Time in seconds to wait for each address. Defaults to 0.1.
+
+    Returns:
+        list: (port, address, reading) for every controller which answered, sorted by port and address
+    """
+    if ports is None:
+        ports = serial_ports(busy=pool.open_ports())
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        results = executor.map(lambda port: scan_port(pool, port, addresses, timeout), ports)
+    return sorted((found for result in results for found in result), key=lambda f: (f[0], f[1]))
+
+
+def populate_boxes(settings:dict, found:list) -> list:
+    """Add a box to the settings for every controller found which no box uses yet
+
+    Args:
+        settings (dict): Application settings, settings['boxes'] is extended in place
+        found (list): Result of scan
+
+    Returns:
+        list: The boxes added
+    """
+    used = {(box['port'], int(box['address'])) for box in settings['boxes']}
+    added = []
+    for port, address, reading in found:
+        if (port, address) in used:
+            continue
+        box = {
+            'address': address,
+            'name': f'Box {len(settings["boxes"]) + 1}',
+            'port': port,
+            'protocol': [],
+            'state': {'status': 'unknown'}}
+        settings['boxes'].append(box)
+        added.append(box)
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the Novus controllers on every serial port')
+    parser.add_argument('ports', nargs='*', help='ports to scan, defaults to every available port')
+    parser.add_argument('--first', type=int, default=ADDRESSES.start, help='first address to try')
+    parser.add_argument('--last', type=int, default=ADDRESSES.stop - 1, help='last address to try')
+    parser.add_argument('--timeout', type=float, default=0.1, help='time in seconds to wait for each address')
+    parser.add_argument('--save', action='store_true', help='add the controllers found to settings.json')
+    args = parser.parse_args()
+
+    pool = ConnectionPool()
+    try:
+        found = scan(pool, args.ports or None, range(args.first, args.last + 1), args.timeout)
+    finally:
+        pool.close()
+
+    for port, address, reading in found:
+        print(f'{port} address {address}: SV {reading.sv} PV {reading.pv}')
+    print(f'found {len(found)} controllers')
+
+    if args.save:
+        with open('settings.json', 'r') as f:
+            settings = json.load(f)
+        added = populate_boxes(settings, found)
+        with open('settings.json', 'w') as f:
+            json.dump(settings, f, sort_keys=True, indent=4)
+        print(f'added {len(added)} boxes to settings.json')
+
+
+if __name__ == "__main__":
+    main()
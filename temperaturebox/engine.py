@@ -0,0 +1,647 @@
+#Standard Library Imports
+import json
+import os
+import threading
+import time
+
+import serial
+
+import novus
+from novus import read_reading, set_sv
+from scheduler import BusScheduler
+from datalog import DataLogger
+from catalog import RunRecorder
+from journal import Journal, RUN_FIELDS, fast_forward
+from protocol import Timeline, normalize, HOLD, RAMP, STABLE, RAMP_INTERVAL
+import ports
+import discovery
+from metrics import metrics, StatsWriter
+from aggregator import Forwarder
+from rtu import RtuPool
+
+
+class Engine(object):
+    def __init__(self, settings:dict, settings_file:str=None):
+        """Polling and protocol engine of the temperature boxes, independent of any user interface
+
+        The state of the boxes is tracked by the self.settings['boxes'] object. Commands (start, stop,
+        protocol and connection changes) can come from any thread, the boxes themselves are only
+        polled and modified by the workers of the scheduler.
+
+        Clients follow what happens through .subscribe, every callback receives event dictionaries:
+            {'event': 'reading', 'box': i, 'state': {...}} after every datapoint
+            {'event': 'status', 'box': i, 'status': status} when a box starts, stops or is done
+            {'event': 'ports', 'ports': [...]} when the available serial ports change
+
+        Args:
+            settings (dict): Application settings, as in settings.json
+            settings_file (str, optional): File the settings are saved to by .save. Defaults to None.
+        """
+        self.settings = settings
+        self.settings_file = settings_file
+
+        # buffered writers of the run files, and their metadata for the catalog
+        self.logger = DataLogger.from_settings(self.settings)
+        self.recorder = RunRecorder()
+
+        # journal of the run transitions, next to the settings file unless set otherwise
+        journal_file = self.settings.get('journal_file')
+        if journal_file is None and settings_file is not None:
+            journal_file = os.path.splitext(settings_file)[0] + '.journal'
+        self.journal = Journal(journal_file, self.settings.get('journal_compact_records', 1000), self.settings.get('journal_fsync', True))
+
+        # compiled protocols, box index -> Timeline, dropped when the protocol changes
+        self.timelines = {}
+        self.resume()
+
+        # transactions in the polling threads with minimalmodbus, or every port on one asyncio loop
+        if self.settings.get('transport') == 'asyncio':
+            novus.pool.close()
+            novus.pool = RtuPool(timeout=self.settings.get('modbus_timeout', 0.5))
+
+        # serial ports found by the last session, refreshed in the background
+        self.ports = ports.load_cache()
+        self.port_scanner = ports.PortScanner(
+            self.update_ports,
+            busy=novus.pool.open_ports,
+            interval=self.settings.get('port_scan_interval', 5.0),
+            ports=self.ports)
+
+        # set values are only written again when they change, or after this long
+        novus.registers.verify_interval = self.settings.get('sv_verify_interval', 600.)
+
+        # instrumentation of the polling, optionally written to a stats file
+        metrics.enabled = self.settings.get('metrics', False)
+        self.stats_writer = None
+        if self.settings.get('metrics_file'):
+            self.stats_writer = StatsWriter(self.settings['metrics_file'], self.settings.get('metrics_interval', 60.))
+
+        # stream of the state of the boxes to an aggregator, see aggregator.py
+        self.forwarder = None
+        if self.settings.get('aggregator'):
+            self.forwarder = Forwarder(self, self.settings['aggregator'], self.settings.get('node_name'), self.settings.get('aggregator_interval', 1.0))
+
+        self.scheduler = BusScheduler(self.settings['boxes'], self.tick, self.settings['sleep'], self.settings.get('poll_threads'), self.prefetch)
+        self.listeners = []
+        self.listeners_lock = threading.Lock()
+
+
+    @classmethod
+    def from_file(cls, settings_file:str='settings.json') -> 'Engine':
+        """Create the engine from a settings file, which is also where .save writes"""
+        with open(settings_file,'r') as f:
+            return cls(json.load(f), settings_file)
+
+
+    # Clients
+
+    def subscribe(self, callback) -> None:
+        """Call callback(event) on every event, from the thread producing it"""
+        with self.listeners_lock:
+            self.listeners.append(callback)
+
+
+    def unsubscribe(self, callback) -> None:
+        with self.listeners_lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+
+    def emit(self, event:dict) -> None:
+        with self.listeners_lock:
+            listeners = list(self.listeners)
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f'Error in event listener: {e}')
+
+
+    def snapshot(self) -> dict:
+        """Copy of the settings and state of every box, safe to serialize while the boxes are polled"""
+        # the C JSON encoder walks the dictionaries without letting other threads run
+        snapshot = json.loads(json.dumps(self.settings))
+        snapshot['ports'] = self.ports
+        return snapshot
+
+
+    def update_ports(self, found:list) -> None:
+        self.ports = found
+        self.emit({'event':'ports', 'ports':found})
+
+
+    # Commands
+
+    def box(self, i:int) -> dict:
+        if not 0 <= i < len(self.settings['boxes']):
+            raise IndexError(f'there is no box {i}')
+        return self.settings['boxes'][i]
+
+
+    def wake(self, i:int) -> None:
+        """Have the scheduler look at a box right away after a command changed it"""
+        self.scheduler.wake(i)
+
+
+    def check(self, i:int) -> novus.Reading:
+        """Read a box once to check its port and address
+
+        Args:
+            i (int): Box index
+        """
+        box = self.box(i)
+        print(f'checking box {i+1} on port {box["port"]} address {box["address"]}')
+        return read_reading(box['port'], box['address'])
+
+
+    def add_step(self, i:int, temperature:float, time:float) -> list:
+        """Add a step to the protocol of a box
+
+        Args:
+            i (int): Box index
+            temperature (float): Set value of the step in C
+            time (float): Duration of the step in hours, negative for infinite
+
+        Raises:
+            ValueError: The box is running
+
+        Returns:
+            list: The protocol of the box
+        """
+        box = self.editable_box(i)
+        box['protocol'].append({'time':float(time), 'temperature':float(temperature), 'step':len(box['protocol'])+1})
+        self.timelines.pop(i, None)
+        return box['protocol']
+
+
+    def set_protocol(self, i:int, protocol:list) -> list:
+        """Replace the protocol of a box
+
+        Args:
+            i (int): Box index
+            protocol (list): Steps as {'temperature', 'time'} dictionaries, or ramps, stable and repeat steps as described
+                in protocol.normalize. The step numbers are generated.
+
+        Raises:
+            ValueError: The protocol is invalid, or the box is running
+
+        Returns:
+            list: The protocol of the box
+        """
+        box = self.editable_box(i)
+        protocol = normalize(protocol)
+        timeline = Timeline.compile(protocol, self.settings.get('ramp_interval', RAMP_INTERVAL))
+        box['protocol'] = protocol
+        self.timelines[i] = timeline
+        return box['protocol']
+
+
+    def editable_box(self, i:int) -> dict:
+        """A box whose protocol can change, the running ones are refused as their current step could vanish"""
+        box = self.box(i)
+        if box['state'].get('status') in ('starting', 'resuming', 'running'):
+            raise ValueError(f'box {i} is running, stop it before changing its protocol')
+        return box
+
+
+    def clear_protocol(self, i:int) -> list:
+        return self.set_protocol(i, [])
+
+
+    def timeline(self, i:int) -> Timeline:
+        """Compiled protocol of a box"""
+        timeline = self.timelines.get(i)
+        if timeline is None:
+            timeline = self.timelines[i] = Timeline.compile(self.box(i)['protocol'], self.settings.get('ramp_interval', RAMP_INTERVAL))
+        return timeline
+
+
+    def sv_at(self, i:int, timestamp:float) -> float:
+        """Set value of a running box at a time, None if its protocol is over by then
+
+        Stable steps still ahead are assumed to take their minimum time.
+
+        Args:
+            i (int): Box index
+            timestamp (float): Time of the set value, from the start of the current step on
+        """
+        state = self.box(i)['state']
+        timeline = self.timeline(i)
+        return timeline.sv_at(timeline.offset(state['current_step']-1, timestamp - state['step_start_timestamp']))
+
+
+    def next_event(self, i:int) -> float:
+        """Timestamp of the next set value change or step of a running box, infinite if none is planned"""
+        state = self.box(i)['state']
+        timeline = self.timeline(i)
+        k = state['current_step'] - 1
+        return state['step_start_timestamp'] - timeline.start(k) + timeline.next_event(timeline.offset(k, time.time() - state['step_start_timestamp']))
+
+
+    def set_connection(self, i:int, port:str=None, address:int=None) -> None:
+        """Change the port and/or the address of a box
+
+        Args:
+            i (int): Box index
+            port (str, optional): New port. Defaults to None, keeping the port.
+            address (int, optional): New address. Defaults to None, keeping the address.
+        """
+        box = self.box(i)
+        if port is not None:
+            box['port'] = port
+        if address is not None:
+            box['address'] = int(address)
+        self.wake(i)
+
+
+    def start(self, i:int, basename:str) -> None:
+        """Mark a box for starting, the actual running of the protocol will occur in .tick
+
+        Args:
+            i (int): Box index
+            basename (str): Name of the data file, without extension
+
+        Raises:
+            ValueError: The box is already running, or has no protocol
+        """
+        box = self.box(i)
+        if box['state'].get('status') in ('starting', 'resuming', 'running'):
+            raise ValueError(f'box {i} is already running, stop it before starting it again')
+        # the journal and the catalog record the end of the previous run on the next tick
+        if self.journal.running(i):
+            raise ValueError(f'box {i} is still stopping, try again')
+        if not len(self.timeline(i)):
+            raise ValueError(f'box {i} has no protocol')
+        box['state'].update({
+            'basename': basename,
+            'filepath': self.logger.filepath(self.settings['data_directory'], basename)})
+        box['state']['status'] = 'starting'
+        self.emit({'event':'status', 'box':i, 'status':'starting'})
+        self.wake(i)
+
+
+    def stop(self, i:int) -> None:
+        """Stop running a box protocol, the journal and the catalog are updated by .tick
+
+        Args:
+            i (int): Box index
+        """
+        box = self.box(i)
+        box['state']['status'] = 'stopped'
+        self.emit({'event':'status', 'box':i, 'status':'stopped'})
+        self.wake(i)
+
+
+    def scan(self) -> list:
+        """Find the controllers on every port, see discovery.scan"""
+        return discovery.scan(novus.pool, self.ports)
+
+
+    def add_boxes(self, found:list) -> list:
+        """Add a box for every controller found by .scan which no box uses yet, see discovery.populate_boxes"""
+        return discovery.populate_boxes(self.settings, found)
+
+
+    def resume(self) -> None:
+        """Pick up the runs interrupted by a crash or by closing the application
+
+        The journal tells which boxes were running, at which step and since when. Steps which ended
+        while the application was down are skipped, and the boxes are left 'resuming' for .tick to
+        write the set value of their current step. Without a journal entry, the state saved in the
+        settings is used.
+        """
+        runs = self.journal.recover()
+        now = time.time()
+        for i, box in enumerate(self.settings['boxes']):
+            run = runs.get(i)
+            if run is None:
+                if box['state'].get('status') not in ('running', 'resuming') or not all(key in box['state'] for key in RUN_FIELDS):
+                    continue
+                run = {key: box['state'][key] for key in RUN_FIELDS}
+                run['status'] = 'running'
+                run['protocol'] = box['protocol']
+            elif run['status'] != 'running':
+                # the settings may predate the end of the run
+                if box['state'].get('status') in ('running', 'resuming', 'starting'):
+                    box['state']['status'] = run['status']
+                continue
+
+            box['protocol'] = run.pop('protocol')
+            self.timelines.pop(i, None)
+            run = fast_forward(run, self.timeline(i), now)
+            if run['status'] == 'done':
+                box['state'].update(run)
+                self.journal.done(i)
+                self.recorder.ended(box, 'done')
+                continue
+            moved = (run['current_step'], run['step_start_timestamp']) != (box['state'].get('current_step'), box['state'].get('step_start_timestamp'))
+            box['state'].update(run)
+            if moved:
+                self.journal.step(i, run['current_step'], run['step_start_timestamp'])
+                self.recorder.stepped(box)
+            box['state']['status'] = 'resuming'
+            box['state'].setdefault('timestamp', run['step_start_timestamp'])
+
+
+    # Polling, all the functions that modify box['state'] should be called from .tick only, in order to avoid
+    # threads modifying the object in an unpredictable manner
+
+    def start_box(self, i:int, box:dict) -> None:
+        box['state'].update({
+            'status':'running',
+            'current_step':1,
+            'start_timestamp':time.time(),
+        })
+        # the rate of change of the PV starts over with the readings of the new run
+        for key in ('pv', 'timestamp', 'pv_rate'):
+            box['state'].pop(key, None)
+
+        self.logger.write_header(box['state']['filepath'])
+        self.emit({'event':'status', 'box':i, 'status':'running'})
+
+        try:
+            self.start_step(i, box, 0)
+            self.update_datapoint(i, box)
+        except Exception:
+            # the scheduler retries the start, rather than running a box which never got its set value
+            if box['state']['status'] == 'running':
+                box['state']['status'] = 'starting'
+            raise
+        # stopped while the set value was written, the run never started as far as the journal knows
+        if box['state']['status'] != 'running':
+            return
+        self.journal.start(i, box)
+        self.recorder.started(i, box, self.logger.backend.name)
+
+
+    def resume_box(self, i:int, box:dict) -> None:
+        """Carry on with a run found by .resume, at its current step and without restarting the step timer"""
+        # the controller may have lost its set value with the power
+        segment = self.segment(i, box)
+        self.write_sv(box, segment.sv_at(time.time() - box['state']['step_start_timestamp']))
+        if box['state']['status'] != 'resuming':
+            return
+        box['state']['stable_since'] = None
+        box['state']['status'] = 'running'
+        self.logger.write_header(box['state']['filepath'])
+        self.emit({'event':'status', 'box':i, 'status':'running'})
+        self.update_datapoint(i, box)
+
+
+    def segment(self, i:int, box:dict):
+        """Segment of the compiled protocol a running box is at"""
+        return self.timeline(i).segment(box['state']['current_step']-1)
+
+
+    def write_sv(self, box:dict, value:float) -> None:
+        # the controller has a resolution of 0.1 C
+        value = round(value, 1)
+        set_sv(value, box['port'], box['address'])
+        box['state']['setpoint'] = value
+
+
+    def start_step(self, i:int, box:dict, istep:int) -> None:
+        """Write the set value of a step, the box only moves to the step once the controller has it"""
+        new_sv = self.timeline(i).segment(istep).sv_at(0.)
+        self.write_sv(box, new_sv)
+
+        box['state'].update({
+            'current_step': istep+1,
+            'step_start_timestamp': time.time(),
+            'stable_since': None})
+
+
+    def push_ramp(self, i:int, box:dict, stamp:float) -> None:
+        """Write the set value a ramp is at, if it moved since the last write"""
+        value = round(self.sv_at(i, stamp), 1)
+        if value != box['state'].get('setpoint'):
+            self.write_sv(box, value)
+
+
+    def update_datapoint(self, i:int, box:dict, scheduled:bool=False) -> None:
+        # get time
+        stamp = time.time()
+        if scheduled:
+            # how far the actual sample interval is from the planned one
+            metrics.observe('sample_jitter_seconds', abs(stamp - box['state']['timestamp'] - box['state'].get('read_interval', self.settings['read_delta'])), box=i)
+        # read data
+        reading = read_reading(box['port'], box['address'])
+        # a controller which lost its set value, after a power cycle for instance, gets it back right away
+        setpoint = box['state'].get('setpoint')
+        if setpoint is not None and abs(reading.sv - setpoint) > 0.05:
+            metrics.increment('sv_restores', port=box['port'], address=box['address'])
+            set_sv(setpoint, box['port'], box['address'], force=True)
+        # rate of change of the PV in C/s, smoothed over about 5 minutes to see through the 0.1 C steps of the readings
+        previous = box['state'].get('pv'), box['state'].get('timestamp')
+        if previous[0] is not None and stamp > previous[1]:
+            dt = stamp - previous[1]
+            rate = box['state'].get('pv_rate', 0.)
+            box['state']['pv_rate'] = rate + dt/(dt + 300.)*((reading.pv - previous[0])/dt - rate)
+        # update internal data structure
+        box['state'].update({
+            'timestamp': stamp,
+            'time_elapsed':stamp -  box['state']['start_timestamp'],
+            'pv':reading.pv,
+            'sv':reading.sv,
+            'output':reading.output})
+        # a stable step ends once the PV stayed close enough to the set value for long enough
+        segment = self.segment(i, box)
+        if segment.kind == STABLE:
+            if abs(reading.pv - segment.temperature) > segment.tolerance:
+                box['state']['stable_since'] = None
+            elif box['state'].get('stable_since') is None:
+                box['state']['stable_since'] = stamp
+        # write data to file
+        with metrics.timer('write_datapoint_seconds'):
+            self.logger.write_datapoint(box['state']['filepath'], box['state'])
+        self.emit({'event':'reading', 'box':i, 'state':dict(box['state'])})
+
+
+    def try_datapoint(self, i:int, box:dict, scheduled:bool=False) -> Exception:
+        """Take a datapoint with .update_datapoint, returning the error if the controller could not be read"""
+        try:
+            self.update_datapoint(i, box, scheduled)
+        except (serial.SerialException, OSError) as e:
+            print(f'Error reading box {i+1}: {e}')
+            return e
+        return None
+
+
+    def read_interval(self, i:int, box:dict) -> float:
+        """Time in seconds between two readings of a running box
+
+        read_delta while the temperature moves: during ramps and stable steps, for settle_time seconds
+        after a step change, and while the PV changes faster than stable_rate C/min. Otherwise the
+        slower read_delta_stable, no longer than the log_max_gap of a compressed log.
+        """
+        fast = self.settings['read_delta']
+        slow = self.settings.get('read_delta_stable', fast)
+        if slow <= fast:
+            return fast
+        if self.logger.deadband > 0:
+            slow = max(fast, min(slow, self.logger.max_gap))
+        state = box['state']
+        if (self.segment(i, box).kind != HOLD
+                or state['timestamp'] - state['step_start_timestamp'] < self.settings.get('settle_time', 600.)
+                or abs(state.get('pv_rate', 0.))*60 > self.settings.get('stable_rate', 0.1)):
+            return fast
+        return slow
+
+
+    def reading_due(self, i:int, box:dict, stamp:float) -> bool:
+        """Whether a running box is due for a reading at timestamp stamp, right away if its step has none yet"""
+        state = box['state']
+        return state['timestamp'] < state['step_start_timestamp'] or stamp - state['timestamp'] >= self.read_interval(i, box)
+
+
+    def prefetch(self, indexes:list) -> None:
+        """Read together the running boxes whose reading is due, for their ticks to pick up, see novus.prefetch"""
+        now = time.time()
+        pairs = []
+        for i in indexes:
+            box = self.settings['boxes'][i]
+            if box['state'].get('status') == 'running' and self.reading_due(i, box, now):
+                pairs.append((box['port'], box['address']))
+        novus.prefetch(pairs)
+
+
+    def step_end(self, i:int, box:dict) -> float:
+        segment = self.segment(i, box)
+        if segment.kind == STABLE:
+            since = box['state'].get('stable_since')
+            return float('inf') if since is None else since + segment.duration
+        # infinite for a hold forever
+        return box['state']['step_start_timestamp'] + segment.duration
+
+
+    def tick(self, i:int, box:dict) -> float:
+        """Poll a box and return when it next needs attention
+
+        Called by the worker of the port of the box, exactly when its next reading or step transition is due, or right away after .wake
+
+        Args:
+            i (int): Box index
+            box (dict): The box
+
+        Returns:
+            float: Timestamp of the next tick, infinite if nothing is due until the next command
+        """
+        if box['state']['status'] == 'starting':
+            self.start_box(i, box)
+        elif box['state']['status'] == 'resuming':
+            self.resume_box(i, box)
+
+        error = None
+        if box['state']['status'] == 'running':
+            stamp = time.time()
+            box['state']['read_interval'] = self.read_interval(i, box)
+            segment = self.segment(i, box)
+            # the other steps end on the clock alone, their next step is written before the reading of the box,
+            # which is then the first one of the new step, so a dropped reply cannot hold back the change
+            changing = segment.kind != STABLE and stamp >= self.step_end(i, box) and box['state']['current_step'] < len(self.timeline(i))
+            # a stable step only ends on a reading confirming the PV is still in range
+            if not changing and (self.reading_due(i, box, stamp) or
+                    (segment.kind == STABLE and stamp >= self.step_end(i, box))):
+                error = self.try_datapoint(i, box, scheduled=True)
+
+            # Check to move on to next step
+            if stamp >= self.step_end(i, box):
+                # a ramp ending the protocol leaves the controller at its final temperature
+                segment = self.segment(i, box)
+                if segment.kind == RAMP and box['state']['current_step'] == len(self.timeline(i)):
+                    self.write_sv(box, segment.temperature)
+                # a stop which came in meanwhile wins
+                if box['state']['status'] == 'running':
+                    # There are no more steps, change status to done
+                    if box['state']['current_step'] >= len(self.timeline(i)):
+                        box['state']['current_step'] += 1
+                        box['state']['status'] = 'done'
+                        self.journal.done(i)
+                        self.recorder.ended(box, 'done')
+                        self.logger.close(box['state']['filepath'])
+                        self.emit({'event':'status', 'box':i, 'status':'done'})
+
+                    # There are more steps, start a new step, retried by the scheduler until its set value is written
+                    else:
+                        try:
+                            self.start_step(i, box, box['state']['current_step'])
+                        except (serial.SerialException, OSError) as e:
+                            # the retry is an event as well, not queued behind the readings of the bus
+                            self.scheduler.expect(i, getattr(e, 'retry_at', time.time() + self.settings['sleep']))
+                            raise
+                        # the first reading of the step is left to the readings of the bus, see .reading_due
+                        if box['state']['status'] == 'running':
+                            self.journal.step(i, box['state']['current_step'], box['state']['step_start_timestamp'])
+                            self.recorder.stepped(box)
+
+            elif self.segment(i, box).kind == RAMP:
+                self.push_ramp(i, box, stamp)
+
+        if box['state']['status'] == 'running':
+            due = self.step_end(i, box)
+            # the next set value of a ramp, the end of a stable step depends on the readings instead
+            if self.segment(i, box).kind != STABLE:
+                due = min(due, self.next_event(i))
+            if due != float('inf'):
+                self.scheduler.expect(i, due)
+            # a failed reading is retried like a failed tick, see BusScheduler.run_tick
+            if error is not None:
+                return min(getattr(error, 'retry_at', time.time() + self.settings['sleep']), due)
+            if self.reading_due(i, box, time.time()):
+                return time.time()
+            return min(box['state']['timestamp'] + self.read_interval(i, box), due)
+        # a stopped run gets its data on disk right away
+        if box['state']['status'] == 'stopped' and 'filepath' in box['state']:
+            self.logger.close(box['state']['filepath'])
+            # only a run the journal has as running was stopped, not a box which was idle or still starting
+            if self.journal.running(i):
+                self.journal.stopped(i)
+                self.recorder.ended(box, 'stopped')
+
+        # nothing to do until a command wakes the box up
+        return float('inf')
+
+
+    # Life cycle
+
+    def run(self) -> None:
+        """Poll the boxes until .close is called"""
+        self.port_scanner.start()
+        if self.stats_writer is not None:
+            self.stats_writer.start()
+        if self.forwarder is not None:
+            self.forwarder.start()
+        self.scheduler.run()
+
+
+    def start_thread(self) -> threading.Thread:
+        """Run the engine in a background thread"""
+        thread = threading.Thread(target=self.run, name='engine', daemon=True)
+        thread.start()
+        return thread
+
+
+    def save(self) -> None:
+        """Write the settings, including the state of the boxes, to the settings file"""
+        if self.settings_file is None:
+            return
+        snapshot = self.snapshot()
+        del snapshot['ports']
+        with open(self.settings_file,'w') as f:
+            json.dump(snapshot, f, sort_keys=True, indent=4)
+
+
+    def close(self) -> None:
+        """Stop polling, flush the data files, compact the journal, save the settings and release the ports"""
+        self.port_scanner.stop()
+        if self.stats_writer is not None:
+            self.stats_writer.stop()
+        if self.forwarder is not None:
+            self.forwarder.stop()
+        # the ticks in progress finish writing before the files, the journal and the ports go
+        if not self.scheduler.stop(self.settings.get('close_timeout', 10.)):
+            print('Some boxes were still being polled when closing, their last datapoints may be lost')
+        self.logger.close()
+        self.journal.close()
+        self.save()
+        novus.pool.close()
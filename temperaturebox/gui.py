@@ -1,18 +1,18 @@
 #Standard Library Imports 
-import glob
-import json
-import os
+import argparse
 import re
-import sys
 import threading 
 import time
 
 # import for GUI implementation
 import PySimpleGUI as sg
 
-# Imports for connecting to Novus
-import serial
-import minimalmodbus
+# Imports for running the boxes, here or in a daemon
+from engine import Engine
+from remote import RemoteEngine
+from history import History
+import protocol
+from metrics import metrics
 
 # This is never used, can we delete?
 def threadwrap(threadfunc):
@@ -112,97 +112,184 @@ def threadwrap(threadfunc):
 #'''
 #
 
-### def Serial_ports()
-### no preconditions 
-### finds the possible serial ports on the system and brute forces them
-def serial_ports():
-    """ Lists serial port names
-
-        :raises EnvironmentError:
-            On unsupported or unknown platforms
-        :returns:
-            A list of the serial ports available on the system
-    """
-    if sys.platform.startswith('win'):
-        ports = ['COM%s' % (i + 1) for i in range(256)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-
-    # list of ports 
-    result = []
-
-    #brute forcing ports
-    for port in ports:
-        try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
-
 def extract_i(event):
     return int(re.match('\w+-([0-9]+)', event).groups()[0])
 
-### Def get_instrument(port, address) -> instrument object 
-### port: string with valid port name 
-### address: 1 <= x <= 256
-### given a port and address, connects to the sought Novus 
-def get_instrument(port, address):
-    instrument = minimalmodbus.Instrument(port, address)
-    instrument.close_port_after_each_call = True
-    instrument.serial.baudrate = 9600
-    instrument.serial.parity = minimalmodbus.serial.PARITY_NONE
-    instrument.serial.bytesize = minimalmodbus.serial.EIGHTBITS
-    instrument.serial.stopbits = minimalmodbus.serial.STOPBITS_ONE
-    return instrument
-
-### def read_sv_port(port, address) -> tuple 
-### port: string with valid port name
-### address: 1<= x<= 256
-### returns the present value and the set value of a specified novus 
-def read_sv_pv(port, address):
-    instrument = get_instrument(port, address)
-    sv = instrument.read_register(0, 0, signed=True)/10.
-    pv = instrument.read_register(1, 0, signed=True)/10.
-    return sv, pv
-
-
-### def set_sv(value, port, address) -> Boolean 
-### value: 20 <= x <= 60
-### port: string with valid port name
-### address: 1<= x<= 256
-### sets the value of the novus to a specified temperature 
-def set_sv(value, port, address):
-    instrument = get_instrument(port, address)
-    instrument.write_register(0, value, 1, signed=True)
-    return True
+# Elements of the panel of a box, their keys are '<name>-<box index>'
+BOX_ELEMENTS = ('port', 'address', 'check', 'checktext', 'temperature', 'time', 'add', 'clear', 'import', 'protocol',
+                'filename', 'start', 'stop', 'status', 'plot')
+# Elements locked while a box is running
+BOX_CONTROLS = ('port', 'address', 'check', 'temperature', 'time', 'add', 'clear', 'import', 'protocol', 'filename', 'start', 'stop')
+
+# Class for the trend plot of a box
+class TrendPlot(object):
+    def __init__(self, graph:sg.Graph, history:History, hours:float):
+        """Plot of the PV (red) and SV (blue) history of a box
+
+        New points are drawn as they come in, the whole plot is only redrawn when the
+        newest point runs off the right edge or out of the temperature range.
+
+        Args:
+            graph (sg.Graph): Graph element drawn on
+            history (History): History of the box, fed by the update thread
+            hours (float): Time span of the plot in hours
+        """
+        self.graph = graph
+        self.history = history
+        self.seconds = hours*3600
+        self.count = 0
+        self.origin = None
+        self.ymin = self.ymax = 0.
+        self.last = None
+
+
+    def draw(self, points:list) -> None:
+        for point in points:
+            if self.last is not None:
+                x0, x1 = self.last[0] - self.origin, point[0] - self.origin
+                self.graph.draw_line((x0, self.last[2]), (x1, point[2]), color='blue')
+                self.graph.draw_line((x0, self.last[1]), (x1, point[1]), color='red')
+            self.last = point
+
+
+    def redraw(self) -> None:
+        points, self.count = self.history.horizon(self.seconds)
+        self.graph.erase()
+        self.last = None
+        if not points:
+            return
+        # leave a quarter of the plot free for the points to come
+        self.origin = points[-1][0] - 0.75*self.seconds
+        values = [v for p in points for v in p[1:]]
+        margin = max(1., 0.1*(max(values) - min(values)))
+        self.ymin, self.ymax = min(values) - margin, max(values) + margin
+        self.graph.change_coordinates((0, self.ymin), (self.seconds, self.ymax))
+        self.draw(points)
+
+
+    def refresh(self) -> None:
+        points, count = self.history.since(self.count)
+        if not points:
+            return
+        out_of_view = (self.origin is None
+            or points[-1][0] - self.origin > self.seconds
+            or any(not self.ymin <= v <= self.ymax for p in points for v in p[1:]))
+        if out_of_view:
+            self.redraw()
+        else:
+            self.count = count
+            self.draw(points)
+
 
 # Class for Client Object
 class Client(object):
-    def __init__(self):
-        """Client object which contains the GUI, logic and state of the temperature boxes
-        The main thread is the window and interaction. Another thread controls the running of the protocols, querying of boxes and writing of data
+    def __init__(self, engine):
+        """Client object which contains the GUI of the temperature boxes
+        The main thread is the window and interaction. The engine controls the running of the protocols, querying of boxes and writing of data,
+        either in a thread of this process (engine.Engine) or in a daemon (remote.RemoteEngine)
 
-        The settings are read from file and written on closing. The GUI is generated from the settings.
+        The GUI is generated from the settings of the engine, and follows the boxes through the events of the engine.
 
-        The state of the boxes are tracked by the self.settings['boxes'] object
+        Args:
+            engine (Engine or RemoteEngine): Engine running the boxes
         """
+        self.engine = engine
+        self.settings = engine.settings
+        self.ports = engine.ports
+
+        # recent datapoints of every box, plotted in the GUI
+        self.histories = [History() for box in self.settings['boxes']]
+
+        # newest state of the boxes, shown at most updates_per_second times per second
+        self.lock = threading.Lock()
+        self.latest = {}       # box index -> newest state from the engine
+        self.changed = set()   # boxes whose newest state is not shown yet
+        self.refresh_posted = False
+        self.last_refresh = 0.
+        self.refresh_interval = 1./self.settings.get('gui_updates_per_second', 4.)
+        self.shown = {}        # box index -> status text on screen
+
+        # panels are built when their page is first shown
+        self.widgets = {}      # box index -> {element name: element}, for the built panels
+        self.plots = {}        # box index -> TrendPlot, for the built panels
+        self.built = set()     # built pages
 
-        # load settings, these are saved and carried over from session to session
-        with open('settings.json','r') as f:
-            self.settings = json.load(f)
-
-        # brute force list all serial ports
-        self.ports = serial_ports()
-        
         # create gui
         self.window = self.make_window()
+        self.build_page(0)
+
+        self.engine.subscribe(self.on_engine_event)
+        metrics.gauge('gui_event_queue', lambda: self.window.thread_queue.qsize())
+
+
+    def on_engine_event(self, event:dict) -> None:
+        """Forward the events of the engine to the GUI thread, called from the threads of the engine
+
+        Args:
+            event (dict): Event of the engine, see engine.Engine
+        """
+        if event['event'] == 'ports':
+            self.window.write_event_value('portlist', event['ports'])
+            return
+        i = event['box']
+        if i >= len(self.histories):
+            return # boxes added after the window was made
+        if event['event'] == 'reading':
+            changes = event['state']
+            self.histories[i].append(changes['timestamp'], changes['pv'], changes['sv'])
+        else:
+            changes = {'status': event['status']}
+
+        # a burst of events makes a single 'refresh' message for the GUI
+        with self.lock:
+            self.latest[i] = dict(self.latest.get(i, {}), **changes)
+            self.changed.add(i)
+            if self.refresh_posted:
+                return
+            self.refresh_posted = True
+            delay = max(0., self.last_refresh + self.refresh_interval - time.monotonic())
+        threading.Timer(delay, self.window.write_event_value, ('refresh', None)).start()
+
+
+    def refresh(self) -> None:
+        """Show the states which changed since the last refresh, called from the GUI thread on a 'refresh' event"""
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            self.refresh_posted = False
+            self.last_refresh = time.monotonic()
+            states = {i: self.latest[i] for i in changed}
+        for i, state in states.items():
+            if i in self.widgets:
+                self.show(i, state)
+
+
+    def show(self, i:int, state:dict) -> None:
+        """Update the status and plot of a box, leaving the elements which did not change alone"""
+        text = self.status_text(state)
+        if text != self.shown.get(i):
+            self.widgets[i]['status'].update(text)
+            self.shown[i] = text
+        self.plots[i].refresh()
+
+
+    def status_text(self, state:dict) -> str:
+        """Text of the status element of a box
+
+        Args:
+            state (dict): State of the box, from a reading event
+        """
+        if 'timestamp' not in state:
+            return f"Status: {state.get('status')}"
+        step_hours = (state['timestamp'] - state['step_start_timestamp'])/3600
+        start_hours = (state['timestamp'] - state['start_timestamp'])/3600
+        return \
+'''Status: {status}
+step: {current_step}
+{start_hours:.2f}h ({step_hours:.2f}h)
+SV: {sv:.2f}
+PV: {pv:.2f}
+Out: {output:.1f}%
+'''.format(step_hours=step_hours, start_hours=start_hours, **state)
 
 
     def check(self, event:str) -> None:
@@ -213,10 +300,8 @@ class Client(object):
         """
         try:
             i = extract_i(event)
-            box = self.settings['boxes'][i]
-            print(f'checking box {i+1} on port {box["port"]} address {box["address"]}')
-            sv, pv = read_sv_pv(box['port'], box['address'])
-            self.window[f'checktext-{i}'].update(f'SV: {sv}\nPV: {pv}')
+            reading = self.engine.check(i)
+            self.window[f'checktext-{i}'].update(f'SV: {reading.sv}\nPV: {reading.pv}')
         except:
             print('error on check')
             self.window[f'checktext-{i}'].update(f'SV: None\nPV: None')
@@ -232,7 +317,7 @@ class Client(object):
             list: List of strings describing the protocol
         """
         box = self.settings['boxes'][ibox]
-        return ["{step}: {temperature:0.2f} C for {time:0.2f} h".format(**p) for p in box['protocol']]
+        return [protocol.describe(p) for p in box['protocol']]
 
 
     def add_protocol_step(self, event:str, values:dict) -> None:
@@ -243,23 +328,82 @@ class Client(object):
             values (dict): Dictionary of window values
         """
         i = extract_i(event)
-        box = self.settings['boxes'][i]
         temperature = float(values[f'temperature-{i}'])
         time = float(values[f'time-{i}'])
-        box['protocol'].append({'time':time, 'temperature':temperature, 'step':len(box['protocol'])+1})
+        self.engine.add_step(i, temperature, time)
+        self.window[f'protocol-{i}'].update(self.gen_protocol_list(i))
+
+
+    def import_protocol(self, event:str) -> None:
+        """Replace the protocol of a box by one read from a JSON or CSV file, see protocol.load
+
+        Args:
+            event (str): Event triggering the import, contains the box index
+        """
+        i = extract_i(event)
+        filepath = sg.popup_get_file('Protocol file', title='Import protocol', file_types=(('Protocols', '*.json *.csv'),))
+        if not filepath:
+            return
+        try:
+            self.engine.set_protocol(i, protocol.load(filepath))
+        except Exception as e:
+            sg.popup_error(f'Could not import the protocol: {e!r}', title='Import protocol')
+            return
         self.window[f'protocol-{i}'].update(self.gen_protocol_list(i))
 
 
     def update_port(self, event, values):
         i = extract_i(event)
-        box = self.settings['boxes'][i]
-        box['port'] = values[event]
+        self.engine.set_connection(i, port=values[event])
+
+
+    def update_port_list(self, found:list) -> None:
+        """Refresh the port choices of every box after a rescan
+
+        Args:
+            found (list): Available serial ports
+        """
+        self.ports = found
+        for i, widgets in self.widgets.items():
+            widgets['port'].update(value=self.settings['boxes'][i]['port'], values=self.ports)
+
+
+    def scan(self) -> None:
+        """Scan every port for controllers in the background, the result comes back as a 'scanned' event
+        """
+        self.window['scan'].update(disabled=True)
+        self.window['scantext'].update('Scanning...')
+        def scan_ports():
+            try:
+                found = self.engine.scan()
+            except Exception as e:
+                print('error on scan '+str(e))
+                found = []
+            self.window.write_event_value('scanned', found)
+        threading.Thread(target=scan_ports, daemon=True).start()
+
+
+    def scanned(self, found:list) -> None:
+        """Report the controllers found by a scan and offer to add the new ones as boxes
+
+        Args:
+            found (list): (port, address, reading) of every controller which answered
+        """
+        self.window['scan'].update(disabled=False)
+        self.window['scantext'].update(f'Found {len(found)} controllers')
+        used = {(box['port'], int(box['address'])) for box in self.settings['boxes']}
+        new = [f for f in found if (f[0], f[1]) not in used]
+        if not new:
+            return
+        text = '\n'.join(f'{port} address {address}: SV {reading.sv} PV {reading.pv}' for port, address, reading in new)
+        answer = sg.popup_yes_no(f'{text}\n\nAdd these {len(new)} controllers as new boxes? They will appear after restarting.', title='Scan')
+        if answer == 'Yes':
+            self.engine.add_boxes(new)
 
 
     def update_address(self, event, values):
         i = extract_i(event)
-        box = self.settings['boxes'][i]
-        box['address'] = values[event]
+        self.engine.set_connection(i, address=values[event])
 
 
     def clear_protocol(self, event:str) -> None:
@@ -269,26 +413,24 @@ class Client(object):
             event (str): Even ttriggering the clear, contains the box index
         """
         i = extract_i(event)
-        box = self.settings['boxes'][i]
-        box['protocol'] = []
-        self.window[f'protocol-{i}'].update(box['protocol'])
+        self.engine.clear_protocol(i)
+        self.window[f'protocol-{i}'].update(self.gen_protocol_list(i))
 
 
     def start_protocol(self, event:str, values:dict) -> None:
-        """Mark a box for starting, the actual running of the protocol will occur in the .update_boxes method
+        """Have the engine start the protocol of a box
 
         Args:
             event (str): Event triggering the start, contains the box index
             values (dict): Dictionary of window values
         """
         i = extract_i(event)
-        box = self.settings['boxes'][i]
-        basename = values[f'filename-{i}']
-        box['state'].update({
-            'basename': basename,
-            'filepath': os.path.join(self.settings['data_directory'], basename+'.csv')})
+        try:
+            self.engine.start(i, values[f'filename-{i}'])
+        except Exception as e:
+            sg.popup_error(f'Could not start box {i+1}: {e}', title='Start')
+            return
         self.set_disabled(i, True, exceptions=[f'stop-{i}'])
-        box['state']['status'] = 'starting'
 
 
     def set_disabled(self, i:int, disabled:bool, exceptions:list=[]) -> None:
@@ -299,16 +441,10 @@ class Client(object):
             disabled (bool): Disable (or enable if False) the controls for the box
             exceptions (list, optional): List of keys of elements which won't be affected. Defaults to [].
         """
-        # lock the interface
-        suffix = f'-{i}'
-        for element in self.window.element_list():
-            if isinstance(element.key, str):
-                if element.key.endswith(suffix):
-                    if element.key not in exceptions:
-                        try:
-                            element.update(disabled=disabled)
-                        except:
-                            pass
+        # lock the interface, a panel not built yet is locked when it is built
+        for name in BOX_CONTROLS:
+            if i in self.widgets and f'{name}-{i}' not in exceptions:
+                self.widgets[i][name].update(disabled=disabled)
 
 
     def stop_protocol(self, event:str) -> None:
@@ -318,161 +454,108 @@ class Client(object):
             event (str): the event triggering the stop, contains the box index
         """
         i = extract_i(event)
-        box = self.settings['boxes'][i]
         # unlock the interface
         self.set_disabled(i, False)
-        box['state']['status'] = 'stopped'
-        self.window[f'status-{i}'].update('Status: stopped')
-
-
-    def update_boxes(self) -> None:
-        """All the functions that modify box['state'] should live within this function in order to avoid threads modifying the object 
-        in an unpredictable manner
-        """
-        def start(box:dict):
-            box['state'].update({
-                'status':'running',
-                'current_step':1,
-                'start_timestamp':time.time(),
-            })
-
-            with open(box['state']['filepath'],'a') as f:
-                f.write('timestamp, time_elapsed, pv, sv\n')
-            
-            start_step(box, 0)
-
-
-        def start_step(box:dict, istep:int) -> None:
-            new_sv = box['protocol'][istep]['temperature']
-            set_sv(new_sv, box['port'], box['address'])
-
-            box['state']['step_start_timestamp'] = time.time()
-            update_datapoint(box)
-            write_datapoint(box)
-            update_status_gui(box)
-
-
-        def update_datapoint(box:dict) -> None:
-            # get time
-            stamp = time.time()
-            # read data
-            sv, pv = read_sv_pv(box['port'], box['address'])
-            # update internal data structure
-            box['state'].update({
-                'timestamp': stamp,
-                'time_elapsed':stamp -  box['state']['start_timestamp'],
-                'pv':pv,
-                'sv':sv})
-
-
-        def write_datapoint(box:dict) -> None:
-            # write data to file
-            with open(box['state']['filepath'],'a') as f:
-                f.write('{timestamp}, {time_elapsed}, {pv:.2f}, {sv:.2f}\n'.format(**box['state']))
-
-            
-        def update_status_gui(box:dict) -> None:
-            # update GUI
-            step_hours = (box['state']['timestamp'] - box['state']['step_start_timestamp'])/3600
-            start_hours = (box['state']['timestamp'] - box['state']['start_timestamp'])/3600
-            status_text = \
-'''Status: {status}
-step: {current_step}
-{start_hours:.2f}h ({step_hours:.2f}h)
-SV: {sv:.2f}
-PV: {pv:.2f}
-'''.format(step_hours=step_hours, start_hours=start_hours, **box['state'])
-            self.window.write_event_value(f'update-{i}', status_text)  # put a message into queue for GUI
-
-        while True:
-            for i,box in enumerate(self.settings['boxes']):
-                try:
-                    if box['state']['status'] == 'starting':
-                        start(box)
-
-                    if box['state']['status'] == 'running':
-                        stamp = time.time()
-                        if stamp - box['state']['timestamp'] > self.settings['read_delta']:
-                            update_datapoint(box)
-                            write_datapoint(box)
-                            update_status_gui(box)
+        self.engine.stop(i)
+        self.widgets[i]['status'].update('Status: stopped')
+        self.shown[i] = 'Status: stopped'
 
-                        # Check to move on to next step
-                        if stamp - box['state']['step_start_timestamp'] > box['protocol'][box['state']['current_step']-1]['time']*3600:
-                            box['state']['current_step'] += 1
 
-                            # There are no more steps, change status to done
-                            if box['state']['current_step'] > len(box['protocol']):
-                                box['state']['status'] = 'done'
-                                self.window.write_event_value(f'update-{i}', 'Status: done')
+    def build_page(self, p:int) -> None:
+        """Build the panels of the boxes of a page, the first time it is shown
 
-                            # There are more steps, start a new step
-                            else:
-                                start_step(box, box['state']['current_step']-1)
-                
-                except Exception as e:
-                    print('Error in update loop '+str(e))
-
-                time.sleep(self.settings['sleep'])
-
-
-    def make_window(self) -> sg.Window:
-        self.layout = []
-        for i, box in enumerate(self.settings['boxes']):
-            self.layout.append(
-                [sg.Frame(box['name'],
-                    [[
-                        sg.Frame('Connection',
-                            [
-                               [
-                                    sg.Column(
-                                        [
-                                            [sg.Combo(self.ports, enable_events=True, default_value=box['port'], key=f'port-{i}', size=(10,None), expand_x=True)],
-                                            [sg.Combo(list(range(1,25)), enable_events=True, default_value=box['address'], key=f'address-{i}',expand_x=True)],
-                                            [sg.Button('Check', key=f'check-{i}', expand_x=True)]
-                                        ]),
-                                    sg.Text('SV:\nPV:', key=f'checktext-{i}', font='courier 10', size=(7,None))
-                                ]
-                            ]
-                        ),
+        Args:
+            p (int): Page index
+        """
+        if p in self.built or p >= len(self.pages):
+            return
+        self.built.add(p)
+        self.window.extend_layout(self.window[f'page-{p}'], [self.box_panel(i, self.settings['boxes'][i]) for i in self.pages[p]])
+        for i in self.pages[p]:
+            self.widgets[i] = {name: self.window[f'{name}-{i}'] for name in BOX_ELEMENTS}
+            self.plots[i] = TrendPlot(self.widgets[i]['plot'], self.histories[i], self.settings.get('plot_hours', 24.))
+            # runs started earlier, or resumed by the engine, keep their controls locked
+            if self.settings['boxes'][i]['state'].get('status') in ('starting', 'resuming', 'running'):
+                self.set_disabled(i, True, exceptions=[f'stop-{i}'])
+            with self.lock:
+                state = self.latest.get(i)
+            if state is not None:
+                self.show(i, state)
+
+
+    def box_panel(self, i:int, box:dict) -> list:
+        """Layout row of the panel of a box"""
+        return [sg.Frame(box['name'],
+            [[
+                sg.Frame('Connection',
+                    [
+                       [
+                            sg.Column(
+                                [
+                                    [sg.Combo(self.ports, enable_events=True, default_value=box['port'], key=f'port-{i}', size=(10,None), expand_x=True)],
+                                    [sg.Combo(list(range(1,25)), enable_events=True, default_value=box['address'], key=f'address-{i}',expand_x=True)],
+                                    [sg.Button('Check', key=f'check-{i}', expand_x=True)]
+                                ]),
+                            sg.Text('SV:\nPV:', key=f'checktext-{i}', font='courier 10', size=(7,None))
+                        ]
+                    ]
+                ),
                         
-                        sg.Frame('Protocol',
-                            [
+                sg.Frame('Protocol',
+                    [
+                        [
+                            sg.Column(
                                 [
-                                    sg.Column(
-                                        [
-                                            [sg.Text('Temperature (C)'), sg.Input('', tooltip='Enter temperature between 30C and 70C', key=f'temperature-{i}', size=(10,None))],
-                                            [sg.Text('Time (h)'), sg.Input('', tooltip='Number of hours, put negative number for infinite time', key=f'time-{i}', size=(10,None), expand_x=True)],
-                                            [sg.Button('Add',key=f'add-{i}'), sg.Button('Clear', key=f'clear-{i}')]
-                                        ]
-                                    ),                        
-                                    sg.Listbox(values=self.gen_protocol_list(i), key=f'protocol-{i}',size=(30,4),font='courier 10')
+                                    [sg.Text('Temperature (C)'), sg.Input('', tooltip='Enter temperature between 30C and 70C', key=f'temperature-{i}', size=(10,None))],
+                                    [sg.Text('Time (h)'), sg.Input('', tooltip='Number of hours, put negative number for infinite time', key=f'time-{i}', size=(10,None), expand_x=True)],
+                                    [sg.Button('Add',key=f'add-{i}'), sg.Button('Clear', key=f'clear-{i}'), sg.Button('Import', key=f'import-{i}', tooltip='Load ramps, loops and stable steps from a JSON or CSV file')]
                                 ]
-                            ]),
+                            ),                        
+                            sg.Listbox(values=self.gen_protocol_list(i), key=f'protocol-{i}',size=(30,4),font='courier 10')
+                        ]
+                    ]),
                         
-                        sg.Frame('Control',
-                            [
+                sg.Frame('Control',
+                    [
+                        [
+                            sg.Column(
                                 [
-                                    sg.Column(
-                                        [
-                                            [sg.Input(box['state'].get('basename',''), tooltip='Filename', key=f'filename-{i}', size=(35,None), expand_x=True)],
-                                            [sg.Button('Start', key=f'start-{i}'), sg.Button('Stop', key=f'stop-{i}')]
-                                        ]
-                                    ),
-                                    sg.Text('Status\n\n\n\n', key=f'status-{i}', font='courier 10', size=(15,None))
+                                    [sg.Input(box['state'].get('basename',''), tooltip='Filename', key=f'filename-{i}', size=(35,None), expand_x=True)],
+                                    [sg.Button('Start', key=f'start-{i}'), sg.Button('Stop', key=f'stop-{i}')]
                                 ]
-                            ])
-                    ]], key=f'frame-{i}')
-                ]
-            )
+                            ),
+                            sg.Text('Status\n\n\n\n', key=f'status-{i}', font='courier 10', size=(15,None))
+                        ]
+                    ]),
 
-        return sg.Window("Cyclikal Temperature Box Controller", self.layout, resizable=True, icon='./cyclikal_light_icon.ico')
+                sg.Frame('Trend',
+                    [
+                        [sg.Graph(canvas_size=(300,100), graph_bottom_left=(0,0), graph_top_right=(1,1), background_color='white', key=f'plot-{i}')]
+                    ])
+            ]], key=f'frame-{i}')
+        ]
+
+
+    def make_window(self) -> sg.Window:
+        """Window with the boxes split into pages of boxes_per_page, the panels are built by .build_page"""
+        self.layout = [[sg.Button('Scan buses', key='scan', tooltip='Find the controllers on every port'), sg.Text('', key='scantext')]]
+        per_page = self.settings.get('boxes_per_page', 8)
+        count = len(self.settings['boxes'])
+        self.pages = [range(first, min(first + per_page, count)) for first in range(0, count, per_page)]
+        if len(self.pages) <= 1:
+            self.layout.append([sg.Column([[]], key='page-0', pad=(0,0))])
+        else:
+            tabs = [sg.Tab(f'Boxes {page[0]+1}-{page[-1]+1}', [[sg.Column([[]], key=f'page-{p}', pad=(0,0))]], key=f'tab-{p}')
+                    for p, page in enumerate(self.pages)]
+            self.layout.append([sg.TabGroup([tabs], key='pages', enable_events=True)])
+
+        return sg.Window("Cyclikal Temperature Box Controller", self.layout, resizable=True, icon='./cyclikal_light_icon.ico', finalize=True)
 
 
     def run(self) -> None:
         """The main event loop for the GUI
         """
-        threading.Thread(target=self.update_boxes, daemon=True).start()
+        self.engine.start_thread()
         window_open = True
         while window_open:  # Event Loop
             event, values = self.window.read()
@@ -485,33 +568,49 @@ PV: {pv:.2f}
                     self.update_address(event, values)
                 elif event.startswith('clear-'):
                     self.clear_protocol(event)
+                elif event.startswith('import-'):
+                    self.import_protocol(event)
                 elif event.startswith('start-'):
                     self.start_protocol(event, values)
                 elif event.startswith('stop-'):
                     self.stop_protocol(event)
                 elif event.startswith('check-'):
                     self.check(event)
-                elif event.startswith('update-'):
-                    i = extract_i(event)
-                    self.window[f'status-{i}'].update(values[event])
+                elif event == 'scan':
+                    self.scan()
+                elif event == 'scanned':
+                    self.scanned(values[event])
+                elif event == 'portlist':
+                    self.update_port_list(values[event])
+                elif event == 'refresh':
+                    self.refresh()
+                elif event == 'pages':
+                    self.build_page(extract_i(values[event]))
 
             if event == sg.WIN_CLOSED or event == 'Exit':
-                with open('settings.json','w') as f:
-                    json.dump(self.settings, f, sort_keys=True, indent=4)
                 window_open = False
 
 
     def close(self) -> None:
+        self.engine.unsubscribe(self.on_engine_event)
         self.window.close()
+        self.engine.close()
 
 
 def main():
+    parser = argparse.ArgumentParser(description='GUI of the Cyclikal temperature boxes')
+    parser.add_argument('--connect', metavar='URL', help='control the boxes of a running daemon.py, e.g. http://127.0.0.1:8765, instead of running them in this window')
+    args = parser.parse_args()
+
+    # the settings are saved and carried over from session to session by the engine
+    engine = RemoteEngine(args.connect) if args.connect else Engine.from_file('settings.json')
+    my_client = Client(engine)
     try:
-        my_client = Client()
         my_client.run()
     except KeyboardInterrupt:
         print("\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         print("Execution Interrupted From Console")
+    finally:
         my_client.close()
         
 
@@ -0,0 +1,121 @@
+#Standard Library Imports
+import threading
+from array import array
+
+
+class RingBuffer(object):
+    def __init__(self, capacity:int, width:int):
+        """Fixed capacity buffer of points, the oldest points are overwritten once it is full
+
+        Each point is a tuple of `width` floats, stored in a single preallocated array so that
+        memory does not grow however long the run is.
+
+        Args:
+            capacity (int): Maximum number of points kept
+            width (int): Number of values per point
+        """
+        self.capacity = capacity
+        self.width = width
+        self.data = array('d', bytes(8*capacity*width))
+        self.count = 0  # total number of points ever appended
+
+
+    def append(self, point:tuple) -> None:
+        start = (self.count % self.capacity)*self.width
+        self.data[start:start+self.width] = array('d', point)
+        self.count += 1
+
+
+    def since(self, count:int) -> list:
+        """Points appended after the first `count` points, limited to the ones still in the buffer
+
+        Args:
+            count (int): Value of .count seen by the caller the last time it read the buffer
+
+        Returns:
+            list: The points as tuples, oldest first
+        """
+        first = max(count, self.count - self.capacity, 0)
+        points = []
+        for n in range(first, self.count):
+            start = (n % self.capacity)*self.width
+            points.append(tuple(self.data[start:start+self.width]))
+        return points
+
+
+    def span(self) -> float:
+        """Difference between the first value of the newest and the oldest points, the time span for (t, ...) points"""
+        if self.count == 0:
+            return 0.
+        newest = ((self.count - 1) % self.capacity)*self.width
+        oldest = (max(self.count - self.capacity, 0) % self.capacity)*self.width
+        return self.data[newest] - self.data[oldest]
+
+
+class History(object):
+    def __init__(self, capacity:int=1024, factor:int=8, tiers:int=3):
+        """In memory history of the (time, pv, sv) points of a box
+
+        The first tier keeps every point. Each following tier keeps the mean of every `factor`
+        points of the tier before it, covering a `factor` times longer horizon in the same memory.
+
+        Fed by the update thread and read by the GUI, so every access goes through .lock
+
+        Args:
+            capacity (int, optional): Points kept per tier. Defaults to 1024.
+            factor (int, optional): Downsampling factor between tiers. Defaults to 8.
+            tiers (int, optional): Number of tiers, including the full resolution one. Defaults to 3.
+        """
+        self.factor = factor
+        self.tiers = [RingBuffer(capacity, 3) for _ in range(tiers)]
+        self.sums = [[0., 0., 0.] for _ in range(tiers - 1)]
+        self.lock = threading.Lock()
+
+
+    def append(self, t:float, pv:float, sv:float) -> None:
+        with self.lock:
+            point = (t, pv, sv)
+            self.tiers[0].append(point)
+            for level, sums in enumerate(self.sums):
+                for k in range(3):
+                    sums[k] += point[k]
+                # the tier above only gets a point every `factor` points of this tier
+                if self.tiers[level].count % self.factor:
+                    break
+                point = tuple(s/self.factor for s in sums)
+                self.sums[level] = [0., 0., 0.]
+                self.tiers[level+1].append(point)
+
+
+    def since(self, count:int) -> tuple:
+        """Full resolution points appended since the caller last read them
+
+        Args:
+            count (int): Counter returned by the previous call, 0 at first
+
+        Returns:
+            tuple: (list of new points, counter to pass to the next call)
+        """
+        with self.lock:
+            return self.tiers[0].since(count), self.tiers[0].count
+
+
+    def horizon(self, seconds:float) -> tuple:
+        """Points covering the last `seconds`, from the finest tier which still holds them
+
+        Returns:
+            tuple: (list of points, full resolution counter to pass to .since for the points that follow)
+        """
+        with self.lock:
+            tier = self.tiers[-1]
+            for candidate in self.tiers:
+                if candidate.count < candidate.capacity or candidate.span() >= seconds:
+                    tier = candidate
+                    break
+            points = tier.since(0)
+            if points and tier is not self.tiers[0]:
+                # the full resolution points newer than the last downsampled one
+                points += [p for p in self.tiers[0].since(0) if p[0] > points[-1][0]]
+            if points:
+                points = [p for p in points if p[0] >= points[-1][0] - seconds]
+            return points, self.tiers[0].count
@@ -0,0 +1,173 @@
+#Standard Library Imports
+import json
+import os
+import threading
+import time
+
+
+# Fields of the state of a box needed to resume its run
+RUN_FIELDS = ('status', 'basename', 'filepath', 'start_timestamp', 'current_step', 'step_start_timestamp')
+
+
+def fast_forward(run:dict, timeline, now:float) -> dict:
+    """Move a run to the segment it should be at now, as if it had kept running
+
+    Segments which ended while the application was down are skipped, except stable ones which
+    need readings, see protocol.Timeline.skip. A run past its last segment is done.
+
+    Args:
+        run (dict): Run fields of the box state, see RUN_FIELDS
+        timeline (protocol.Timeline): Compiled protocol of the run
+        now (float): Current timestamp
+
+    Returns:
+        dict: The updated run
+    """
+    run = dict(run)
+    if run['status'] != 'running':
+        return run
+    k = run['current_step'] - 1
+    j = timeline.skip(k, now - run['step_start_timestamp'])
+    if j >= len(timeline):
+        run['status'] = 'done'
+    elif j != k:
+        run['step_start_timestamp'] += timeline.start(j) - timeline.start(k)
+        run['current_step'] = j + 1
+    return run
+
+
+class Journal(object):
+    def __init__(self, filepath:str=None, compact_records:int=1000, fsync:bool=True):
+        """Append-only journal of the run transitions of the boxes, to resume the runs after a crash
+
+        Every start, step change, completion and stop is appended as one JSON line and forced to
+        disk before the engine carries on. The journal also folds the records into the current run
+        of every box, so compacting it into a single snapshot line costs nothing, and recovering
+        only reads the snapshot and the records appended since. A line torn by a crash is ignored.
+
+        Args:
+            filepath (str, optional): Journal file. Defaults to None, keeping the runs in memory only.
+            compact_records (int, optional): Compact the journal once this many records follow the snapshot. Defaults to 1000.
+            fsync (bool, optional): Force every record to disk. Defaults to True.
+        """
+        self.filepath = filepath
+        self.compact_records = compact_records
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.runs = {}  # box index -> run fields and protocol
+        self.records = 0
+        self.file = None
+        self.closed = False
+
+
+    def recover(self) -> dict:
+        """Read the journal and compact it, call once before any record is appended
+
+        Returns:
+            dict: Box index -> last run of the box, with the RUN_FIELDS and its 'protocol'
+        """
+        with self.lock:
+            if self.filepath is not None and os.path.exists(self.filepath):
+                with open(self.filepath, 'r') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        self.fold(record)
+            self._compact()
+            return {i: dict(run) for i, run in self.runs.items()}
+
+
+    def fold(self, record:dict) -> None:
+        """Apply a record to the runs"""
+        event = record['event']
+        if event == 'snapshot':
+            self.runs = {int(i): run for i, run in record['runs'].items()}
+            return
+        i = record['box']
+        if event == 'start':
+            self.runs[i] = {key: record[key] for key in RUN_FIELDS + ('protocol',) if key in record}
+            return
+        run = self.runs.get(i)
+        if run is None:
+            return
+        if event == 'step':
+            run.update(current_step=record['step'], step_start_timestamp=record['at'])
+        elif event in ('done', 'stopped'):
+            run['status'] = event
+
+
+    def append(self, record:dict) -> None:
+        record['time'] = time.time()
+        with self.lock:
+            if self.closed:
+                raise ValueError(f'the journal is closed, the {record["event"]} record of box {record["box"]} was not written')
+            self.fold(record)
+            if self.file is None:
+                return
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.records += 1
+            if self.records >= self.compact_records:
+                self._compact()
+
+
+    def start(self, i:int, box:dict) -> None:
+        """Record the start of the run of box i, with its protocol"""
+        record = {key: box['state'][key] for key in RUN_FIELDS}
+        record.update(event='start', box=i, protocol=box['protocol'])
+        self.append(record)
+
+
+    def step(self, i:int, step:int, at:float) -> None:
+        """Record that box i started step number `step` at timestamp `at`"""
+        self.append({'event':'step', 'box':i, 'step':step, 'at':at})
+
+
+    def done(self, i:int) -> None:
+        self.append({'event':'done', 'box':i})
+
+
+    def stopped(self, i:int) -> None:
+        self.append({'event':'stopped', 'box':i})
+
+
+    def running(self, i:int) -> bool:
+        """Whether the last run recorded for box i is still running"""
+        with self.lock:
+            run = self.runs.get(i)
+            return run is not None and run['status'] == 'running'
+
+
+    def compact(self) -> None:
+        """Replace the journal by a snapshot of the runs"""
+        with self.lock:
+            self._compact()
+
+
+    def _compact(self) -> None:
+        if self.filepath is None:
+            return
+        if self.file is not None:
+            self.file.close()
+        temporary = self.filepath + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(json.dumps({'event':'snapshot', 'time':time.time(), 'runs':self.runs}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.filepath)
+        self.file = open(self.filepath, 'a')
+        self.records = 0
+
+
+    def close(self) -> None:
+        """Compact and close the journal, which refuses any record from then on"""
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self._compact()
+                self.file.close()
+                self.file = None
@@ -0,0 +1,183 @@
+#Standard Library Imports
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the histogram buckets, 1 ms to about a minute
+BUCKETS = tuple(0.001*2**k for k in range(17))
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        """Distribution of durations in log spaced buckets, see BUCKETS"""
+        self.counts = [0]*(len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+
+    def quantile(self, q:float) -> float:
+        """Upper bound of the bucket holding the q quantile"""
+        rank = q*self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+    def as_dict(self) -> dict:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total/self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)}
+
+
+def _key(name:str, labels:dict) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={v}' for k, v in sorted(labels.items())) + '}'
+
+
+class Metrics(object):
+    def __init__(self, enabled:bool=False):
+        """Registry of the latency histograms, counters and gauges of the application
+
+        Nothing is recorded while .enabled is False, so the instrumentation of the hot path
+        costs next to nothing until it is switched on.
+
+        Args:
+            enabled (bool, optional): Record the measurements. Defaults to False.
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+
+
+    def observe(self, name:str, value:float, **labels) -> None:
+        """Add a measurement to the histogram name{labels}"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+
+    def increment(self, name:str, value:int=1, **labels) -> None:
+        """Add to the counter name{labels}"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def gauge(self, name:str, callback) -> None:
+        """Register a gauge, callback() is evaluated when a snapshot is taken"""
+        with self.lock:
+            self.gauges[name] = callback
+
+
+    @contextmanager
+    def timer(self, name:str, **labels):
+        """Context manager observing its duration in the histogram name{labels}"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            histograms = {key: h.as_dict() for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        values = {}
+        for name, callback in gauges.items():
+            try:
+                values[name] = callback()
+            except Exception:
+                values[name] = None
+        return {
+            'enabled': self.enabled,
+            'since': self.started,
+            'timestamp': time.time(),
+            'histograms': histograms,
+            'counters': counters,
+            'gauges': values}
+
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+
+# Metrics of the whole application
+metrics = Metrics()
+
+
+class StatsWriter(threading.Thread):
+    def __init__(self, filepath:str, interval:float=60.):
+        """Thread writing a snapshot of the metrics to a JSON file every interval
+
+        Args:
+            filepath (str): Stats file, replaced on every write
+            interval (float, optional): Time in seconds between two writes. Defaults to 60.
+        """
+        super().__init__(name='stats-writer', daemon=True)
+        self.filepath = filepath
+        self.interval = interval
+        self.stopped = threading.Event()
+
+
+    def write(self) -> None:
+        temporary = self.filepath + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(metrics.snapshot(), f, indent=4)
+        os.replace(temporary, self.filepath)
+
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f'could not write the stats file: {e}')
+
+
+    def stop(self) -> None:
+        self.stopped.set()
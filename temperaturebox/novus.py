@@ -0,0 +1,221 @@
+#Standard Library Imports
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from connection import ConnectionPool
+from metrics import metrics
+
+# Holding registers of the Novus N1050, values are signed with one decimal place
+REGISTER_SV = 0      # active set value
+REGISTER_PV = 1      # present value
+REGISTER_OUTPUT = 2  # control output power, 0.0 to 100.0 %
+
+# Contiguous block read by a single transaction, starting at REGISTER_SV
+BLOCK_START = REGISTER_SV
+BLOCK_COUNT = 3
+
+
+@dataclass(frozen=True)
+class Reading:
+    """One reading of a Novus controller
+
+    Attributes:
+        sv (float): Set value in C
+        pv (float): Present value in C
+        output (float): Control output power in %
+    """
+    sv: float
+    pv: float
+    output: float
+
+
+def to_signed(register:int) -> int:
+    """Interpret a raw 16 bit register as a two's complement integer"""
+    return register - 0x10000 if register & 0x8000 else register
+
+
+def decode_block(registers:list) -> Reading:
+    """Decode the registers of a block read starting at BLOCK_START
+
+    Args:
+        registers (list): Raw unsigned register values as returned by read_registers
+
+    Returns:
+        Reading: The decoded reading
+    """
+    if len(registers) < BLOCK_COUNT:
+        raise ValueError(f'expected {BLOCK_COUNT} registers, got {len(registers)}')
+    values = [to_signed(r)/10. for r in registers]
+    return Reading(
+        sv=values[REGISTER_SV - BLOCK_START],
+        pv=values[REGISTER_PV - BLOCK_START],
+        output=values[REGISTER_OUTPUT - BLOCK_START])
+
+
+class RegisterCache(object):
+    def __init__(self, verify_interval:float=600.):
+        """Last values written to the holding registers of every controller, to leave out redundant writes
+
+        A write of the value a register already holds is skipped. Writes to the same register queued
+        behind the bus lock collapse into the last one, the earlier values being stale by the time
+        the bus is free. The cached values are checked against the registers read by read_reading,
+        and a value cached for longer than verify_interval is written again regardless, in case the
+        controller lost it without the application reading it.
+
+        Args:
+            verify_interval (float, optional): Time in seconds after which a cached value is written again. Defaults to 600.
+        """
+        self.verify_interval = verify_interval
+        self.lock = threading.Lock()
+        self.values = {}   # (port, address, register) -> (value, monotonic time of the write)
+        self.pending = {}  # (port, address, register) -> newest value waiting for the bus
+
+
+    def write(self, port:str, address:int, register:int, value:float, write) -> bool:
+        """Write a register through the cache
+
+        Args:
+            port (str): Port of the controller
+            address (int): Address of the controller
+            register (int): Holding register
+            value (float): Value to write
+            write (callable): write(value) performs the transaction, called with the port lock held
+
+        Returns:
+            bool: True if the value was written, False if it was already there or superseded by a newer value
+        """
+        key = (port, address, register)
+        with self.lock:
+            self.pending[key] = value
+        with pool.port_lock(port):
+            with self.lock:
+                if key not in self.pending:
+                    # a later call wrote its newer value while this one waited for the bus
+                    metrics.increment('writes_coalesced', port=port)
+                    return False
+                value = self.pending.pop(key)
+                cached = self.values.get(key)
+                if cached is not None and cached[0] == value and time.monotonic() - cached[1] < self.verify_interval:
+                    metrics.increment('writes_skipped', port=port)
+                    return False
+            try:
+                write(value)
+            except Exception:
+                self.forget(port, address, register)
+                raise
+            with self.lock:
+                self.values[key] = (value, time.monotonic())
+            return True
+
+
+    def check(self, port:str, address:int, register:int, value:float) -> None:
+        """Compare a value read from a register with the cache, forgetting the cached value if they differ"""
+        key = (port, address, register)
+        with self.lock:
+            cached = self.values.get(key)
+            # the register holds one decimal place
+            if cached is not None and abs(cached[0] - value) > 0.05:
+                del self.values[key]
+                metrics.increment('register_mismatches', port=port)
+
+
+    def forget(self, port:str=None, address:int=None, register:int=None) -> None:
+        """Drop the cached values matching the arguments, all of them by default"""
+        with self.lock:
+            for key in list(self.values):
+                if all(k is None or k == v for k, v in zip((port, address, register), key)):
+                    del self.values[key]
+
+
+# Open Modbus connections shared by every thread of the application
+pool = ConnectionPool()
+
+# Values written to the controllers
+registers = RegisterCache()
+
+# Readings taken ahead of their tick by prefetch, (port, address) -> (values or exception, monotonic time)
+prefetched = {}
+prefetched_lock = threading.Lock()
+
+# Prefetched readings older than this in seconds are read again
+PREFETCH_AGE = 1.0
+
+@contextmanager
+def timed(name, port, address):
+    # latency of a transaction, per box and per port, including the wait for the bus
+    if not metrics.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe(name, duration, port=port, address=address)
+        metrics.observe(name, duration, port=port)
+
+### Def get_instrument(port, address) -> instrument object 
+### port: string with valid port name 
+### address: 1 <= x <= 256
+### given a port and address, returns the pooled connection to the sought Novus 
+### the port stays open between calls, use pool.connection() to hold the bus while talking to it
+def get_instrument(port, address):
+    return pool.get_instrument(port, address)
+
+### def read_reading(port, address) -> Reading
+### port: string with valid port name
+### address: 1<= x<= 256
+### reads the set value, present value and output power of a specified novus in one transaction
+def read_reading(port, address):
+    with prefetched_lock:
+        values, stamp = prefetched.pop((port, int(address)), (None, None))
+    if values is None or time.monotonic() - stamp > PREFETCH_AGE:
+        with timed('read_seconds', port, address), pool.connection(port, address) as instrument:
+            values = instrument.read_registers(BLOCK_START, BLOCK_COUNT)
+    elif isinstance(values, Exception):
+        raise values
+    reading = decode_block(values)
+    registers.check(port, address, REGISTER_SV, reading.sv)
+    return reading
+
+### def prefetch(pairs) -> None
+### pairs: list of (port, address)
+### reads several novus at once for the next read_reading of each, the ones on different ports in parallel
+### does nothing unless the pool reads in parallel, see rtu.RtuPool.read_many
+def prefetch(pairs):
+    read_many = getattr(pool, 'read_many', None)
+    if read_many is None or not pairs:
+        return
+    results = read_many(pairs, BLOCK_START, BLOCK_COUNT)
+    now = time.monotonic()
+    with prefetched_lock:
+        for pair, result in results.items():
+            prefetched[pair] = (result, now)
+
+### def read_sv_port(port, address) -> tuple 
+### port: string with valid port name
+### address: 1<= x<= 256
+### returns the present value and the set value of a specified novus 
+def read_sv_pv(port, address):
+    reading = read_reading(port, address)
+    return reading.sv, reading.pv
+
+
+### def set_sv(value, port, address) -> Boolean 
+### value: 20 <= x <= 60
+### port: string with valid port name
+### address: 1<= x<= 256
+### force: write even if the controller is known to have the value already
+### sets the value of the novus to a specified temperature, returns False when the write was not needed
+def set_sv(value, port, address, force=False):
+    if force:
+        registers.forget(port, address, REGISTER_SV)
+    def write(value):
+        with timed('write_sv_seconds', port, address), pool.connection(port, address) as instrument:
+            instrument.write_register(REGISTER_SV, value, 1, signed=True)
+        # a reading taken ahead of the write has the previous set value
+        with prefetched_lock:
+            prefetched.pop((port, int(address)), None)
+    return registers.write(port, address, REGISTER_SV, value, write)
@@ -0,0 +1,116 @@
+#Standard Library Imports
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Imports for connecting to Novus
+import serial
+from serial.tools import list_ports
+
+
+CACHE_FILE = 'ports_cache.json'
+
+
+def candidate_ports() -> list:
+    """Serial ports listed by the operating system, without opening them"""
+    return sorted(p.device for p in list_ports.comports())
+
+
+def probe(port:str) -> bool:
+    """Check that a port can be opened"""
+    try:
+        s = serial.Serial(port)
+        s.close()
+        return True
+    except (OSError, serial.SerialException):
+        return False
+
+
+def serial_ports(candidates:list=None, busy:set=(), timeout:float=2.0) -> list:
+    """Lists the serial ports which can be opened, probing them in parallel
+
+    Args:
+        candidates (list, optional): Ports to probe. Defaults to None, probing every port listed by the system.
+        busy (set, optional): Ports held open by this application, listed without probing. Defaults to ().
+        timeout (float, optional): Time in seconds after which the ports still probing are left out. Defaults to 2.0.
+
+    Returns:
+        list: The available serial ports, sorted
+    """
+    if candidates is None:
+        candidates = candidate_ports()
+    result = [port for port in candidates if port in busy]
+    to_probe = [port for port in candidates if port not in busy]
+    if to_probe:
+        executor = ThreadPoolExecutor(max_workers=min(16, len(to_probe)))
+        futures = {executor.submit(probe, port): port for port in to_probe}
+        done, _ = wait(futures, timeout=timeout)
+        # a port hanging on open is not waited for
+        executor.shutdown(wait=False)
+        result += [futures[f] for f in done if f.result()]
+    return sorted(result)
+
+
+def load_cache(filepath:str=CACHE_FILE) -> list:
+    """Ports found by the previous session, empty if there are none"""
+    try:
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def save_cache(ports:list, filepath:str=CACHE_FILE) -> None:
+    try:
+        with open(filepath, 'w') as f:
+            json.dump(ports, f, indent=4)
+    except OSError as e:
+        print(f'could not save the port cache: {e}')
+
+
+class PortScanner(threading.Thread):
+    def __init__(self, callback, busy=lambda: set(), interval:float=5.0, ports:list=None, cache:str=CACHE_FILE):
+        """Background thread keeping the list of available serial ports up to date
+
+        The system listing is checked every `interval` seconds, which is cheap. The ports are only
+        probed again when that listing changes, for instance when a USB adapter is plugged in.
+
+        Args:
+            callback (callable): callback(ports) called with the new list whenever it changes
+            busy (callable, optional): Returns the ports held open by the application, which can't be probed. Defaults to none.
+            interval (float, optional): Time in seconds between two checks. Defaults to 5.0.
+            ports (list, optional): Currently known ports, for instance from the cache. Defaults to None.
+            cache (str, optional): File where the list is saved for the next session. Defaults to CACHE_FILE.
+        """
+        super().__init__(name='port-scanner', daemon=True)
+        self.callback = callback
+        self.busy = busy
+        self.interval = interval
+        self.ports = ports
+        self.cache = cache
+        self.stopped = threading.Event()
+
+
+    def scan(self, candidates:list) -> None:
+        ports = serial_ports(candidates, busy=self.busy())
+        if ports != self.ports:
+            self.ports = ports
+            save_cache(ports, self.cache)
+            self.callback(ports)
+
+
+    def run(self) -> None:
+        listed = None
+        while not self.stopped.is_set():
+            try:
+                candidates = candidate_ports()
+                if candidates != listed:
+                    listed = candidates
+                    self.scan(candidates)
+            except Exception as e:
+                print(f'Error while scanning the ports: {e}')
+            self.stopped.wait(self.interval)
+
+
+    def stop(self) -> None:
+        self.stopped.set()
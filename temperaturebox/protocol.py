@@ -0,0 +1,345 @@
+#Standard Library Imports
+import csv
+import json
+import math
+from bisect import bisect_right
+from dataclasses import dataclass, replace
+
+
+HOLD = 'hold'      # set the temperature and keep it for a time, forever if the time is negative
+RAMP = 'ramp'      # move the set value linearly to the temperature over a time
+STABLE = 'stable'  # set the temperature and wait until the PV stays within a tolerance of it for some minutes
+REPEAT = 'repeat'  # run a block of steps a number of times
+
+# Seconds between two set values written during a ramp, unless the ramp says otherwise
+RAMP_INTERVAL = 60.
+
+def normalize(protocol:list) -> list:
+    """Check a protocol and give it the canonical form stored in the settings
+
+    A protocol is a list of steps, each a dictionary with an optional 'type', HOLD by default:
+        {'temperature': C, 'time': h}                                         hold, negative time for infinite
+        {'type': 'ramp', 'temperature': C, 'time': h, 'from': C, 'interval': s}   'from' and 'interval' optional
+        {'type': 'stable', 'temperature': C, 'tolerance': C, 'minutes': min}
+        {'type': 'repeat', 'count': n, 'steps': [...]}                        steps nested at will
+    The top level steps are numbered in their 'step' key.
+
+    Args:
+        protocol (list): Steps of the protocol
+
+    Raises:
+        ValueError: The protocol is invalid
+        KeyError: A step lacks a required key
+
+    Returns:
+        list: The protocol in canonical form
+    """
+    normalized = [normalize_step(p) for p in protocol]
+    for n, p in enumerate(normalized):
+        p['step'] = n + 1
+    return normalized
+
+
+def normalize_step(p:dict) -> dict:
+    kind = p.get('type', HOLD)
+    if kind == HOLD:
+        return {'time':float(p['time']), 'temperature':float(p['temperature'])}
+    if kind == RAMP:
+        step = {'type':RAMP, 'time':float(p['time']), 'temperature':float(p['temperature'])}
+        if step['time'] < 0:
+            raise ValueError('a ramp needs a positive time')
+        if p.get('from') is not None:
+            step['from'] = float(p['from'])
+        if p.get('interval') is not None:
+            step['interval'] = float(p['interval'])
+            if step['interval'] <= 0:
+                raise ValueError('the interval of a ramp must be positive')
+        return step
+    if kind == STABLE:
+        step = {'type':STABLE, 'temperature':float(p['temperature']), 'tolerance':float(p['tolerance']), 'minutes':float(p['minutes'])}
+        if step['tolerance'] < 0 or step['minutes'] < 0:
+            raise ValueError('the tolerance and minutes of a stable step must be positive')
+        return step
+    if kind == REPEAT:
+        count = int(p['count'])
+        if count < 0:
+            raise ValueError('the count of a repeat block must be positive')
+        return {'type':REPEAT, 'count':count, 'steps':[normalize_step(s) for s in p['steps']]}
+    raise ValueError(f'unknown step type {kind!r}')
+
+
+def describe(p:dict) -> str:
+    """One line description of a step"""
+    kind = p.get('type', HOLD)
+    prefix = f"{p['step']}: " if 'step' in p else ''
+    if kind == RAMP:
+        return prefix + f"ramp to {p['temperature']:0.2f} C in {p['time']:0.2f} h"
+    if kind == STABLE:
+        return prefix + f"{p['temperature']:0.2f} C until within {p['tolerance']:0.2f} C for {p['minutes']:0.0f} min"
+    if kind == REPEAT:
+        return prefix + f"repeat {p['count']}x: " + ', '.join(describe(s) for s in p['steps'])
+    return prefix + f"{p['temperature']:0.2f} C for {p['time']:0.2f} h"
+
+
+def load(filepath:str) -> list:
+    """Read a protocol from a file
+
+    JSON files hold the list of steps, or an object with a "protocol" list, as described in normalize.
+    CSV files have a header line and one step per line, with the temperature and time columns and
+    optionally the type, tolerance, minutes, from and interval columns. Repeat blocks need JSON.
+
+    Args:
+        filepath (str): Path of the protocol file
+
+    Returns:
+        list: The protocol in canonical form
+    """
+    if filepath.lower().endswith('.csv'):
+        with open(filepath, 'r', newline='') as f:
+            steps = [{key: value for key, value in row.items() if value not in (None, '')} for row in csv.DictReader(f)]
+    else:
+        with open(filepath, 'r') as f:
+            steps = json.load(f)
+        if isinstance(steps, dict):
+            steps = steps['protocol']
+    return normalize(steps)
+
+
+@dataclass(frozen=True)
+class Segment:
+    """Step of a compiled protocol, in seconds"""
+    kind: str
+    temperature: float
+    duration: float         # infinite for a hold forever, minimum duration of a stable segment
+    start: float = None     # initial set value of a ramp, None to start from the previous segment
+    tolerance: float = 0.
+    interval: float = None  # seconds between the set values written during a ramp
+
+    def sv_at(self, elapsed:float) -> float:
+        """Set value at a time in seconds since the start of the segment"""
+        if self.kind != RAMP or self.duration <= 0:
+            return self.temperature
+        fraction = min(1., max(0., elapsed/self.duration))
+        return self.start + (self.temperature - self.start)*fraction
+
+    def next_push(self, elapsed:float) -> float:
+        """Time since the start of the segment when the next set value of a ramp is due, infinite if none"""
+        if self.kind != RAMP:
+            return float('inf')
+        push = (math.floor(elapsed/self.interval) + 1)*self.interval
+        return push if push < self.duration else float('inf')
+
+
+def compile_block(protocol:list, ramp_interval:float=RAMP_INTERVAL) -> 'Block':
+    """Compile a protocol into a Block, without unrolling its repeat blocks"""
+    def build(steps, count):
+        items = []
+        for p in steps:
+            kind = p.get('type', HOLD)
+            if kind == REPEAT:
+                nested = build(p['steps'], p['count'])
+                # a block repeated 0 times or with no steps has no segments
+                if len(nested):
+                    items.append(nested)
+            elif kind == RAMP:
+                items.append(Segment(RAMP, p['temperature'], p['time']*3600, start=p.get('from'), interval=p.get('interval', ramp_interval)))
+            elif kind == STABLE:
+                items.append(Segment(STABLE, p['temperature'], p['minutes']*60, tolerance=p['tolerance']))
+            else:
+                # a negative step time runs forever
+                items.append(Segment(HOLD, p['temperature'], float('inf') if p['time'] < 0 else p['time']*3600))
+        return Block(items, count)
+
+    return build(protocol, 1)
+
+
+def _size(item) -> int:
+    return 1 if isinstance(item, Segment) else len(item)
+
+
+class Block(object):
+    def __init__(self, items:list, count:int=1):
+        """Steps repeated count times, each item being a Segment or a nested Block
+
+        Only the prefix sums of one iteration are kept, the segments of the other iterations are
+        found arithmetically, so a protocol cycling thousands of times takes the memory of its text.
+
+        Args:
+            items (list): Segments and Blocks of one iteration, none of them empty
+            count (int, optional): Number of iterations. Defaults to 1.
+        """
+        self.items = items
+        self.count = count
+        self.firsts = [0]   # index of the first segment of every item in an iteration, and the segments of an iteration
+        self.starts = [0.]  # offset of the start of every item in an iteration, and the duration of an iteration
+        self.stable = []    # items holding a stable segment
+        self.first_stable = None  # index of the first stable segment of an iteration
+        for j, item in enumerate(items):
+            if isinstance(item, Segment) and item.kind == STABLE or isinstance(item, Block) and item.first_stable is not None:
+                self.stable.append(j)
+                if self.first_stable is None:
+                    self.first_stable = self.firsts[j] + (0 if isinstance(item, Segment) else item.first_stable)
+            self.firsts.append(self.firsts[-1] + _size(item))
+            self.starts.append(self.starts[-1] + item.duration)
+
+
+    def __len__(self) -> int:
+        return self.firsts[-1]*self.count
+
+
+    @property
+    def duration(self) -> float:
+        return self.starts[-1]*self.count if self.count else 0.
+
+
+    def iteration_start(self, iteration:int) -> float:
+        # an infinite iteration times 0 is still 0
+        return iteration*self.starts[-1] if iteration else 0.
+
+
+    def locate(self, k:int) -> tuple:
+        """(segment, offset of its start) of segment k of the block"""
+        iteration, r = divmod(k, self.firsts[-1])
+        j = bisect_right(self.firsts, r) - 1
+        item = self.items[j]
+        start = self.iteration_start(iteration) + self.starts[j]
+        if isinstance(item, Segment):
+            return item, start
+        segment, offset = item.locate(r - self.firsts[j])
+        return segment, start + offset
+
+
+    def index(self, offset:float) -> int:
+        """Index of the segment running at an offset within the block"""
+        period = self.starts[-1]
+        iteration = 0 if period in (0., float('inf')) else min(int(offset//period), self.count - 1)
+        r = offset - self.iteration_start(iteration)
+        j = min(max(0, bisect_right(self.starts, r) - 1), len(self.items) - 1)
+        item = self.items[j]
+        k = iteration*self.firsts[-1] + self.firsts[j]
+        if isinstance(item, Segment):
+            return k
+        return k + item.index(r - self.starts[j])
+
+
+    def next_stable(self, k:int) -> int:
+        """Index of the first stable segment from segment k on, None if there is none"""
+        if self.first_stable is None:
+            return None
+        n = self.firsts[-1]
+        iteration, r = divmod(k, n)
+        if iteration >= self.count:
+            return None
+        base = iteration*n
+        j = bisect_right(self.firsts, r) - 1
+        item = self.items[j]
+        if isinstance(item, Block):
+            found = item.next_stable(r - self.firsts[j])
+            if found is not None:
+                return base + self.firsts[j] + found
+        elif item.kind == STABLE:
+            return base + r
+        following = bisect_right(self.stable, j)
+        if following < len(self.stable):
+            j = self.stable[following]
+            item = self.items[j]
+            return base + self.firsts[j] + (0 if isinstance(item, Segment) else item.first_stable)
+        if iteration + 1 < self.count:
+            return base + n + self.first_stable
+        return None
+
+
+class Timeline(object):
+    def __init__(self, block:Block):
+        """Compiled protocol, answering what the set value is and when the next event is due in O(log n)
+
+        Times are offsets in seconds from the start of the protocol, with the stable segments taking
+        their minimum duration. Once a run is past a stable segment, offsets are counted from the
+        actual start of the current segment, see .offset. Segments are numbered as in the unrolled
+        protocol, but only looked up in the Block tree.
+
+        Args:
+            block (Block): Compiled protocol, see compile_block
+
+        Raises:
+            ValueError: The protocol starts with a ramp with no 'from' temperature
+        """
+        self.block = block
+        if len(block) and block.locate(0)[0].kind == RAMP and block.locate(0)[0].start is None:
+            raise ValueError("a ramp at the start of a protocol needs a 'from' temperature")
+
+
+    @classmethod
+    def compile(cls, protocol:list, ramp_interval:float=RAMP_INTERVAL) -> 'Timeline':
+        return cls(compile_block(protocol, ramp_interval))
+
+
+    def __len__(self) -> int:
+        return len(self.block)
+
+
+    @property
+    def duration(self) -> float:
+        return self.block.duration
+
+
+    def segment(self, k:int) -> Segment:
+        """Segment k, a ramp with no 'from' starting at the temperature of the segment before it"""
+        segment, _ = self.block.locate(k)
+        if segment.kind == RAMP and segment.start is None:
+            segment = replace(segment, start=self.block.locate(k-1)[0].temperature)
+        return segment
+
+
+    def start(self, k:int) -> float:
+        """Offset of the start of segment k, the duration of the protocol for k == len(self)"""
+        if k >= len(self.block):
+            return self.duration
+        return self.block.locate(k)[1]
+
+
+    def offset(self, k:int, elapsed:float) -> float:
+        """Offset of a time `elapsed` seconds into segment k"""
+        return self.start(k) + elapsed
+
+
+    def index(self, offset:float) -> int:
+        """Index of the segment running at an offset, len(self) past the end of the protocol"""
+        if offset >= self.duration:
+            return len(self.block)
+        return self.block.index(max(0., offset))
+
+
+    def sv_at(self, offset:float) -> float:
+        """Set value at an offset, None past the end of the protocol"""
+        k = self.index(offset)
+        if k == len(self.block):
+            return None
+        return self.segment(k).sv_at(offset - self.start(k))
+
+
+    def next_event(self, offset:float) -> float:
+        """Offset of the next change of the set value or of segment after an offset, infinite if none"""
+        k = self.index(offset)
+        if k == len(self.block):
+            return float('inf')
+        segment = self.segment(k)
+        start = self.start(k)
+        return min(start + segment.next_push(offset - start), start + segment.duration)
+
+
+    def skip(self, k:int, elapsed:float) -> int:
+        """Segment reached `elapsed` seconds after the start of segment k, with no readings in between
+
+        A stable segment ends on the readings of the PV, so it is never skipped.
+
+        Returns:
+            int: Index of the segment, len(self) past the end of the protocol
+        """
+        if k >= len(self.block) or self.segment(k).kind == STABLE:
+            return k
+        j = self.index(self.offset(k, elapsed))
+        following = self.block.next_stable(k + 1)
+        if following is not None:
+            j = min(j, following)
+        return j
@@ -0,0 +1,151 @@
+#Standard Library Imports
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import novus
+
+
+class RemoteError(Exception):
+    """Error returned by the engine daemon"""
+
+
+class RemoteEngine(object):
+    def __init__(self, url:str, timeout:float=10.):
+        """Client of an engine running in daemon.py, with the same commands as engine.Engine
+
+        Args:
+            url (str): Base URL of the daemon, e.g. http://127.0.0.1:8765
+            timeout (float, optional): Timeout in seconds of the commands. Defaults to 10.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.listeners = []
+        self.closed = threading.Event()
+        self.stream = None
+        snapshot = self.request('GET', '/settings')
+        self.ports = snapshot.pop('ports')
+        self.settings = snapshot
+
+
+    def request(self, method:str, path:str, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RemoteError(json.loads(e.read()).get('error', str(e)))
+
+
+    # Clients
+
+    def subscribe(self, callback) -> None:
+        self.listeners.append(callback)
+
+
+    def unsubscribe(self, callback) -> None:
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+
+    def emit(self, event:dict) -> None:
+        # keep the local copy of the state up to date for .settings readers
+        if 'box' in event and event['box'] >= len(self.settings['boxes']):
+            return
+        if event['event'] == 'reading':
+            self.settings['boxes'][event['box']]['state'].update(event['state'])
+        elif event['event'] == 'status':
+            self.settings['boxes'][event['box']]['state']['status'] = event['status']
+        elif event['event'] == 'ports':
+            self.ports = event['ports']
+        for callback in list(self.listeners):
+            try:
+                callback(event)
+            except Exception as e:
+                print(f'Error in event listener: {e}')
+
+
+    def follow_events(self) -> None:
+        """Relay the event stream of the daemon to the listeners, reconnecting when it drops"""
+        while not self.closed.is_set():
+            try:
+                with urllib.request.urlopen(self.url + '/events') as self.stream:
+                    for line in self.stream:
+                        if line.strip():
+                            self.emit(json.loads(line))
+            except Exception as e:
+                if not self.closed.is_set():
+                    print(f'lost the event stream of {self.url}: {e}')
+            self.closed.wait(1.)
+
+
+    # Commands
+
+    def box(self, i:int) -> dict:
+        return self.settings['boxes'][i]
+
+
+    def check(self, i:int) -> novus.Reading:
+        return novus.Reading(**self.request('POST', f'/boxes/{i}/check'))
+
+
+    def add_step(self, i:int, temperature:float, time:float) -> list:
+        self.box(i)['protocol'] = self.request('POST', f'/boxes/{i}/steps', {'temperature':temperature, 'time':time})
+        return self.box(i)['protocol']
+
+
+    def set_protocol(self, i:int, protocol:list) -> list:
+        self.box(i)['protocol'] = self.request('PUT', f'/boxes/{i}/protocol', {'protocol':protocol})
+        return self.box(i)['protocol']
+
+
+    def clear_protocol(self, i:int) -> list:
+        self.box(i)['protocol'] = self.request('DELETE', f'/boxes/{i}/protocol')
+        return self.box(i)['protocol']
+
+
+    def set_connection(self, i:int, port:str=None, address:int=None) -> None:
+        self.request('POST', f'/boxes/{i}/connection', {'port':port, 'address':address})
+        if port is not None:
+            self.box(i)['port'] = port
+        if address is not None:
+            self.box(i)['address'] = int(address)
+
+
+    def start(self, i:int, basename:str) -> None:
+        self.request('POST', f'/boxes/{i}/start', {'basename':basename})
+        self.box(i)['state']['basename'] = basename
+
+
+    def stop(self, i:int) -> None:
+        self.request('POST', f'/boxes/{i}/stop')
+
+
+    def scan(self) -> list:
+        found = self.request('POST', '/scan')
+        return [(f.pop('port'), f.pop('address'), novus.Reading(**f)) for f in found]
+
+
+    def add_boxes(self, found:list) -> list:
+        return self.request('POST', '/boxes', {'found':[{'port':port, 'address':address} for port, address, reading in found]})
+
+
+    # Life cycle
+
+    def start_thread(self) -> threading.Thread:
+        """Follow the events of the daemon in a background thread"""
+        thread = threading.Thread(target=self.follow_events, name='remote-events', daemon=True)
+        thread.start()
+        return thread
+
+
+    def close(self) -> None:
+        """Stop following the daemon, which keeps running"""
+        self.closed.set()
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except Exception:
+                pass
@@ -0,0 +1,414 @@
+#Standard Library Imports
+import asyncio
+import struct
+import threading
+import time
+import types
+
+# Imports for connecting to Novus
+import serial
+import minimalmodbus
+
+from connection import ConnectionPool, PortBackoffError
+from metrics import metrics
+
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_REGISTERS = 16
+
+
+def crc16(data:bytes) -> int:
+    """Modbus RTU CRC of a frame"""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def with_crc(data:bytes) -> bytes:
+    return data + struct.pack('<H', crc16(data))
+
+
+def check_frame(request:bytes, response:bytes) -> bytes:
+    """Payload of a response frame, without its address, function code and CRC
+
+    Raises:
+        minimalmodbus.InvalidResponseError: The CRC, address or function code is wrong
+        minimalmodbus.SlaveReportedException: The controller answered with an exception code
+    """
+    if crc16(response[:-2]) != struct.unpack('<H', response[-2:])[0]:
+        raise minimalmodbus.InvalidResponseError(f'wrong CRC in the response {response.hex()}')
+    if response[0] != request[0]:
+        raise minimalmodbus.InvalidResponseError(f'response from address {response[0]} to a request for address {request[0]}')
+    if response[1] == request[1] | 0x80:
+        code = response[2]
+        if code == 1 or code == 2 or code == 3:
+            raise minimalmodbus.IllegalRequestError(f'the controller refused the request, exception code {code}')
+        if code == 6:
+            raise minimalmodbus.SlaveDeviceBusyError('the controller is busy')
+        raise minimalmodbus.SlaveReportedException(f'the controller reported exception code {code}')
+    if response[1] != request[1]:
+        raise minimalmodbus.InvalidResponseError(f'response with function code {response[1]} to function code {request[1]}')
+    return response[2:-2]
+
+
+def response_length(request:bytes):
+    """Function telling the length of the response to a request from its first bytes, None if it needs more"""
+    function = request[1]
+    def length(buffer:bytes) -> int:
+        if len(buffer) < 3:
+            return None
+        if buffer[1] & 0x80:
+            return 5
+        if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+            return 5 + buffer[2]
+        return 8
+    return length
+
+
+class RtuBus(object):
+    def __init__(self, loop:asyncio.AbstractEventLoop, handle:serial.Serial):
+        """One RS485 bus driven from the event loop of an RtuTransport
+
+        Transactions are serialized by an asyncio lock and separated by the 3.5 character silence
+        Modbus RTU requires between frames. A response ends once the number of bytes its function
+        code calls for has arrived. The port is watched with loop.add_reader where the loop supports
+        it, and otherwise polled once per character time while a response is awaited.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Loop of the transport, the bus is only used from it
+            handle (serial.Serial): Open port, read without blocking
+        """
+        self.loop = loop
+        self.handle = handle
+        # a character is 11 bits on the line: start, 8 data bits, parity or a second stop bit, and stop
+        self.character_time = 11./handle.baudrate
+        # fixed silence above 19200 baud, as the specification recommends
+        self.silence = 3.5*self.character_time if handle.baudrate <= 19200 else 0.00175
+        self.lock = asyncio.Lock()
+        self.idle_since = 0.  # loop time of the end of the last frame on the line
+        self.buffer = bytearray()
+        self.received = asyncio.Event()
+        self.error = None  # failure of the port seen by .on_readable
+        self.watched = False
+        try:
+            loop.add_reader(handle.fileno(), self.on_readable)
+            self.watched = True
+        except (NotImplementedError, AttributeError, OSError, ValueError):
+            pass
+
+
+    def on_readable(self) -> None:
+        try:
+            self.buffer += self.handle.read(self.handle.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            self.error = e
+            self.close()
+        self.received.set()
+
+
+    def close(self) -> None:
+        if self.watched:
+            self.watched = False
+            try:
+                self.loop.remove_reader(self.handle.fileno())
+            except (OSError, ValueError):
+                pass
+
+
+    async def wait_bytes(self, deadline:float) -> bool:
+        """Wait for bytes after the ones in .buffer, False if none came before the deadline"""
+        have = len(self.buffer)
+        while len(self.buffer) == have:
+            if self.error is not None:
+                raise serial.SerialException(f'port {self.handle.port} failed: {self.error}')
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                return False
+            if self.watched:
+                self.received.clear()
+                try:
+                    await asyncio.wait_for(self.received.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return False
+            else:
+                waiting = self.handle.in_waiting
+                if waiting:
+                    self.buffer += self.handle.read(waiting)
+                else:
+                    await asyncio.sleep(min(timeout, self.character_time))
+        return True
+
+
+    async def transact(self, request:bytes, timeout:float) -> bytes:
+        """Send a request frame and return the payload of its response
+
+        Args:
+            request (bytes): Request frame, with its CRC
+            timeout (float): Time in seconds the controller has to start answering once the request is sent
+
+        Raises:
+            minimalmodbus.NoResponseError: The response did not come in time
+            minimalmodbus.ModbusException: The response is invalid or reports an error, see check_frame
+            serial.SerialException: The port failed
+
+        Returns:
+            bytes: Payload of the response
+        """
+        length = response_length(request)
+        async with self.lock:
+            delay = self.idle_since + self.silence - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not self.watched and self.handle.in_waiting:
+                self.handle.reset_input_buffer()
+            # an answer which came after its request timed out is not the answer to this one
+            self.buffer.clear()
+            self.handle.write(request)
+            # the response can only start once the request is on the line
+            sent = self.loop.time() + len(request)*self.character_time
+            try:
+                while True:
+                    expected = length(self.buffer)
+                    if expected is not None and len(self.buffer) >= expected:
+                        break
+                    deadline = sent + timeout + (expected or 5)*self.character_time
+                    if not await self.wait_bytes(deadline):
+                        received = f', got {bytes(self.buffer).hex()}' if self.buffer else ''
+                        raise minimalmodbus.NoResponseError(f'no answer from address {request[0]} within {timeout}s{received}')
+                response = bytes(self.buffer[:expected])
+            finally:
+                self.buffer.clear()
+                self.idle_since = self.loop.time()
+        return check_frame(request, response)
+
+
+class RtuTransport(object):
+    def __init__(self, timeout:float=0.5):
+        """Modbus RTU master driving every port from a single asyncio event loop
+
+        The loop runs in its own thread, started on first use. Coroutines such as .read_registers
+        run the transactions of different ports concurrently, while the ones of a port wait for
+        each other, so polling dozens of buses takes one thread rather than one blocked thread
+        per bus. .call is the synchronous facade for the threads of the application. Once stopped,
+        the transport refuses any further transaction rather than starting a new loop.
+
+        Args:
+            timeout (float, optional): Time in seconds a controller has to start answering. Defaults to 0.5.
+        """
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.stopped = False
+        self.buses = {}  # port -> RtuBus, only touched from the loop
+
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        """The loop of the transport, started if needed"""
+        with self.lock:
+            if self.stopped:
+                raise serial.SerialException('the Modbus transport is stopped')
+            if self.thread is None or not self.thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='modbus-rtu', daemon=True)
+                self.thread.start()
+            return self.loop
+
+
+    def call(self, coroutine):
+        """Run a coroutine on the loop and wait for its result, from any other thread"""
+        try:
+            loop = self.start()
+        except serial.SerialException:
+            coroutine.close()
+            raise
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+    def stop(self) -> None:
+        with self.lock:
+            self.stopped = True
+            if self.thread is None:
+                return
+            loop, thread, self.loop, self.thread = self.loop, self.thread, None, None
+        async def detach_all():
+            for port in list(self.buses):
+                self.buses.pop(port).close()
+        asyncio.run_coroutine_threadsafe(detach_all(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(1.)
+        loop.close()
+
+
+    async def attach(self, port:str, handle:serial.Serial) -> None:
+        """Drive an open port, replacing the previous handle of the port"""
+        previous = self.buses.pop(port, None)
+        if previous is not None:
+            previous.close()
+        self.buses[port] = RtuBus(asyncio.get_running_loop(), handle)
+
+
+    async def detach(self, port:str) -> None:
+        bus = self.buses.pop(port, None)
+        if bus is not None:
+            bus.close()
+
+
+    def bus(self, port:str) -> RtuBus:
+        bus = self.buses.get(port)
+        if bus is None:
+            raise serial.SerialException(f'port {port} is not open')
+        return bus
+
+
+    async def read_registers(self, port:str, address:int, start:int, count:int, functioncode:int=READ_HOLDING_REGISTERS, timeout:float=None) -> list:
+        """Raw unsigned values of count registers starting at start"""
+        request = with_crc(struct.pack('>BBHH', address, functioncode, start, count))
+        payload = await self.bus(port).transact(request, self.timeout if timeout is None else timeout)
+        if payload[0] != 2*count or len(payload) != 1 + 2*count:
+            raise minimalmodbus.InvalidResponseError(f'expected {count} registers, got {payload.hex()}')
+        return list(struct.unpack(f'>{count}H', payload[1:]))
+
+
+    async def write_registers(self, port:str, address:int, start:int, values:list, functioncode:int=WRITE_MULTIPLE_REGISTERS, timeout:float=None) -> None:
+        """Write raw unsigned values to the registers starting at start, one register with function code 6"""
+        if functioncode == WRITE_SINGLE_REGISTER:
+            if len(values) != 1:
+                raise ValueError('function code 6 writes a single register')
+            request = with_crc(struct.pack('>BBHH', address, functioncode, start, values[0]))
+        else:
+            request = with_crc(struct.pack(f'>BBHHB{len(values)}H', address, functioncode, start, len(values), 2*len(values), *values))
+        payload = await self.bus(port).transact(request, self.timeout if timeout is None else timeout)
+        if payload != request[2:6]:
+            raise minimalmodbus.InvalidResponseError(f'unexpected echo {payload.hex()} of a write')
+
+
+class RtuInstrument(object):
+    def __init__(self, transport:RtuTransport, port:str, address:int):
+        """Synchronous stand-in for minimalmodbus.Instrument, talking through an RtuTransport
+
+        Only the calls the application makes are provided: read_registers and write_register.
+        """
+        self.transport = transport
+        self.port = port
+        self.address = address
+        # where minimalmodbus keeps the read timeout, which discovery lowers while probing
+        self.serial = types.SimpleNamespace(timeout=transport.timeout)
+
+
+    def read_registers(self, registeraddress:int, number_of_registers:int, functioncode:int=READ_HOLDING_REGISTERS) -> list:
+        return self.transport.call(self.transport.read_registers(
+            self.port, self.address, registeraddress, number_of_registers, functioncode, self.serial.timeout))
+
+
+    def write_register(self, registeraddress:int, value:float, number_of_decimals:int=0, functioncode:int=WRITE_MULTIPLE_REGISTERS, signed:bool=False) -> None:
+        raw = int(round(value*10**number_of_decimals))
+        low, high = (-0x8000, 0x7FFF) if signed else (0, 0xFFFF)
+        if not low <= raw <= high:
+            raise ValueError(f'{value} does not fit in a register')
+        self.transport.call(self.transport.write_registers(
+            self.port, self.address, registeraddress, [raw & 0xFFFF], functioncode, self.serial.timeout))
+
+
+class RtuPool(ConnectionPool):
+    def __init__(self, baudrate:int=9600, timeout:float=0.5, backoff_initial:float=1.0, backoff_max:float=60.0):
+        """ConnectionPool whose transactions run on the event loop of an RtuTransport
+
+        The ports, backoffs and error handling are those of ConnectionPool, only the instruments
+        differ: a thread waiting for an answer blocks on the loop rather than on the serial port,
+        and the framing, CRC and timing are handled by RtuBus.
+        """
+        super().__init__(baudrate, timeout, backoff_initial, backoff_max)
+        self.transport = RtuTransport(timeout)
+
+
+    def _open_serial(self, port:str) -> serial.Serial:
+        handle = self._serials.get(port)
+        if handle is not None and handle.is_open:
+            return handle
+        handle = super()._open_serial(port)
+        # the loop must never block on the port
+        handle.timeout = 0
+        self.transport.call(self.transport.attach(port, handle))
+        return handle
+
+
+    def get_instrument(self, port:str, address:int) -> RtuInstrument:
+        address = int(address)
+        with self.port_lock(port):
+            self._open_serial(port)
+            instrument = self._instruments.get((port, address))
+            if instrument is None:
+                instrument = self._instruments[(port, address)] = RtuInstrument(self.transport, port, address)
+            return instrument
+
+
+    def read_many(self, pairs:list, start:int, count:int) -> dict:
+        """Read the same registers of several controllers in one go, the ones on different ports in parallel
+
+        The backoffs and errors are handled as in .connection, with the locks of every port held.
+
+        Args:
+            pairs (list): (port, address) of the controllers
+            start (int): First register
+            count (int): Number of registers
+
+        Returns:
+            dict: (port, address) -> raw register values, or the exception the read raised
+        """
+        pairs = [(port, int(address)) for port, address in pairs]
+        # always locked in the same order, so two callers cannot hold each other's ports
+        locks = [self.port_lock(port) for port in sorted({port for port, _ in pairs})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            results = {}
+            ready = []
+            for port, address in pairs:
+                try:
+                    self._check_backoff(port, address)
+                    self._open_serial(port)
+                except (serial.SerialException, OSError) as e:
+                    if not isinstance(e, PortBackoffError):
+                        self._outcome(port, address, e)
+                    results[(port, address)] = e
+                    continue
+                ready.append((port, address))
+
+            async def read(port, address):
+                begin = time.perf_counter()
+                try:
+                    values = await self.transport.read_registers(port, address, start, count)
+                except (serial.SerialException, OSError) as e:
+                    return e
+                metrics.observe('read_seconds', time.perf_counter() - begin, port=port, address=address)
+                metrics.observe('read_seconds', time.perf_counter() - begin, port=port)
+                return values
+
+            async def read_all():
+                return await asyncio.gather(*(read(port, address) for port, address in ready))
+
+            for (port, address), result in zip(ready, self.transport.call(read_all())):
+                self._outcome(port, address, result if isinstance(result, Exception) else None)
+                results[(port, address)] = result
+            return results
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+    def _close_port(self, port:str) -> None:
+        if self.transport.thread is not None:
+            self.transport.call(self.transport.detach(port))
+        super()._close_port(port)
+
+
+    def close(self, port:str=None) -> None:
+        super().close(port)
+        if port is None:
+            self.transport.stop()
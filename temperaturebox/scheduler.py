@@ -0,0 +1,236 @@
+#Standard Library Imports
+import heapq
+import threading
+import time
+
+from metrics import metrics
+
+
+class BusWorker(threading.Thread):
+    def __init__(self, scheduler, key:str):
+        """Thread polling every box on one serial port, or on a group of ports
+
+        Boxes on the same RS485 bus are serialized in this thread. The deadlines of the boxes are kept
+        in a heap, the thread sleeps exactly until the earliest one and wakes up early when a box is
+        rescheduled with .schedule. The events of the boxes, their step changes and ramp set values,
+        have a heap of their own and are ticked ahead of the boxes only due for a reading.
+
+        Args:
+            scheduler (BusScheduler): Scheduler owning the worker
+            key (str): Port polled by this worker, or name of its group of ports, see BusScheduler.worker_key
+        """
+        super().__init__(name=f'bus-{key}', daemon=True)
+        self.scheduler = scheduler
+        self.key = key
+        self.heap = []       # (deadline, box index), entries not matching .deadlines are stale
+        self.deadlines = {}  # box index -> timestamp of the next tick
+        self.event_heap = [] # (timestamp, box index), entries not matching .events are stale
+        self.events = {}     # box index -> timestamp of the next event
+        self.condition = threading.Condition()
+
+
+    def schedule(self, i:int, deadline:float, event:bool=False) -> None:
+        """Tick box i at the deadline, or earlier if it was already due earlier
+
+        Args:
+            i (int): Box index
+            deadline (float): Timestamp of the tick
+            event (bool, optional): The tick changes the set value of the box and goes before the readings. Defaults to False.
+        """
+        heap, deadlines = (self.event_heap, self.events) if event else (self.heap, self.deadlines)
+        with self.condition:
+            if deadline < deadlines.get(i, float('inf')):
+                deadlines[i] = deadline
+                heapq.heappush(heap, (deadline, i))
+            self.condition.notify()
+
+
+    def pop_due(self, heap:list, deadlines:dict, now:float) -> list:
+        """Indexes of the boxes of a heap due by now, call with the condition held"""
+        due = []
+        while heap and heap[0][0] <= now:
+            deadline, i = heapq.heappop(heap)
+            if deadlines.get(i) != deadline:
+                continue
+            del deadlines[i]
+            metrics.observe('tick_lateness_seconds', now - deadline, port=self.scheduler.boxes[i]['port'])
+            due.append(i)
+        return due
+
+
+    def due_events(self) -> list:
+        """Indexes of the boxes whose event is due"""
+        with self.condition:
+            return self.pop_due(self.event_heap, self.events, time.time())
+
+
+    def next_due(self) -> list:
+        """Wait for the earliest deadline and return the indexes of every box due by then, events first, None once the scheduler is stopped
+
+        Records how late the tick starts compared to its deadline in the tick_lateness_seconds metric
+        """
+        with self.condition:
+            while not self.scheduler.stopped.is_set():
+                # drop the entries superseded by a later .schedule
+                for heap, deadlines in ((self.heap, self.deadlines), (self.event_heap, self.events)):
+                    while heap and deadlines.get(heap[0][1]) != heap[0][0]:
+                        heapq.heappop(heap)
+
+                if not self.heap and not self.event_heap:
+                    self.condition.wait()
+                    continue
+
+                now = time.time()
+                timeout = min(heap[0][0] for heap in (self.heap, self.event_heap) if heap) - now
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                events = self.pop_due(self.event_heap, self.events, now)
+                return events + [i for i in self.pop_due(self.heap, self.deadlines, now) if i not in events]
+        return None
+
+
+    def tick(self, i:int) -> None:
+        with metrics.timer('tick_seconds', port=self.scheduler.boxes[i]['port']):
+            deadline = self.scheduler.run_tick(i)
+        if deadline != float('inf'):
+            self.schedule(i, deadline)
+
+
+    def run(self) -> None:
+        while True:
+            due = self.next_due()
+            if due is None:
+                return
+            # the boxes moved to another port, their new worker owns them now
+            due = [i for i in due if self.scheduler.worker_key(self.scheduler.boxes[i]['port']) == self.key]
+            # a worker shared by several ports reads their due boxes together, rather than one port after the other
+            if self.scheduler.prefetch is not None and len({self.scheduler.boxes[i]['port'] for i in due}) > 1:
+                try:
+                    self.scheduler.prefetch(due)
+                except Exception as e:
+                    print(f'Error prefetching the readings of boxes {[i+1 for i in due]}: {e}')
+            for i in due:
+                self.tick(i)
+                # an event which came due meanwhile does not wait for the readings left
+                for j in self.due_events():
+                    if self.scheduler.worker_key(self.scheduler.boxes[j]['port']) == self.key:
+                        self.tick(j)
+
+
+class BusScheduler(object):
+    def __init__(self, boxes:list, tick, retry:float, max_workers:int=None, prefetch=None):
+        """Polls the boxes with one worker per serial port
+
+        Boxes on different ports are polled in parallel, so a full sweep is bounded by the slowest
+        bus rather than by the sum of all of them. Each box is ticked exactly at the deadline returned
+        by the tick function, which covers both its next reading and its next step transition. A box
+        with nothing due returns float('inf') and is left alone until .wake is called for it. The tick
+        function can also announce the next event of a box with .expect, which is then ticked on time
+        even when the bus is busy with the readings of the other boxes.
+
+        With max_workers, the ports share that many workers, assigned in the order the ports are first
+        seen, which bounds the number of threads when there are dozens of ports. The ticks of ports
+        sharing a worker run one after the other, but the boxes of several ports due at the same time
+        are first handed together to the prefetch function, which can read them in parallel.
+
+        Args:
+            boxes (list): The box dictionaries, as in settings['boxes']
+            tick (callable): tick(i, box) -> float, polls box i and returns the timestamp of its next tick
+            retry (float): Time in seconds before ticking again a box whose tick failed
+            max_workers (int, optional): Largest number of worker threads. Defaults to None, one worker per port.
+            prefetch (callable, optional): prefetch(indexes), reads ahead the boxes about to be ticked together. Defaults to None.
+        """
+        self.boxes = boxes
+        self.tick = tick
+        self.retry = retry
+        self.max_workers = max_workers
+        self.prefetch = prefetch
+        self.groups = {}   # port -> key of its worker, when the workers are shared
+        self.workers = {}  # worker key -> BusWorker
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+
+    def run_tick(self, i:int) -> float:
+        """Tick box i, falling back to a retry if the tick fails, when the backoff of its port or address ends if it is the cause"""
+        try:
+            return self.tick(i, self.boxes[i])
+        except Exception as e:
+            print(f'Error in update loop on box {i+1}: {e}')
+            return getattr(e, 'retry_at', time.time() + self.retry)
+
+
+    def worker_key(self, port:str) -> str:
+        """Key of the worker polling a port"""
+        if self.max_workers is None:
+            return port
+        with self.lock:
+            key = self.groups.get(port)
+            if key is None:
+                key = self.groups[port] = f'group-{len(self.groups) % self.max_workers}'
+            return key
+
+
+    def worker(self, port:str) -> BusWorker:
+        """The worker of a port, started on first use"""
+        key = self.worker_key(port)
+        with self.lock:
+            worker = self.workers.get(key)
+            if worker is None or not worker.is_alive():
+                worker = self.workers[key] = BusWorker(self, key)
+                worker.start()
+            return worker
+
+
+    def expect(self, i:int, timestamp:float) -> None:
+        """Tick box i at the timestamp of its next event, ahead of the boxes only due for a reading
+
+        Called from the tick function for the step changes and ramp set values, which should not wait
+        for the readings of the other boxes of a busy bus.
+
+        Args:
+            i (int): Box index
+            timestamp (float): Timestamp of the event
+        """
+        self.worker(self.boxes[i]['port']).schedule(i, timestamp, event=True)
+
+
+    def wake(self, i:int=None) -> None:
+        """Tick a box immediately, after a command changed its state or its port
+
+        Args:
+            i (int, optional): Box index. Defaults to None, waking every box.
+        """
+        indexes = range(len(self.boxes)) if i is None else [i]
+        now = time.time()
+        for i in indexes:
+            self.worker(self.boxes[i]['port']).schedule(i, now)
+
+
+    def run(self) -> None:
+        """Tick every box once, then let the workers run until .stop is called"""
+        self.wake()
+        self.stopped.wait()
+
+
+    def stop(self, timeout:float=10.) -> bool:
+        """Stop the workers and wait for the ticks in progress to finish
+
+        Args:
+            timeout (float, optional): Longest time in seconds to wait for the workers. Defaults to 10.
+
+        Returns:
+            bool: Whether every worker finished in time
+        """
+        self.stopped.set()
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            with worker.condition:
+                worker.condition.notify()
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            if worker is not threading.current_thread():
+                worker.join(max(0., deadline - time.monotonic()))
+        return not any(worker.is_alive() for worker in workers if worker is not threading.current_thread())
@@ -0,0 +1,203 @@
+#Standard Library Imports
+import argparse
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+import novus
+from rtu import crc16, with_crc
+
+
+class SimulatedN1050(object):
+    def __init__(self, pv:float=25., sv:float=25., tau:float=600., ambient:float=25., speedup:float=1.):
+        """Software model of a Novus N1050 controlling a temperature box
+
+        The present value follows the set value with first order dynamics of time constant tau,
+        and the output power is proportional to the gap between the equilibrium and ambient
+        temperature plus the remaining error.
+
+        Args:
+            pv (float, optional): Initial present value in C. Defaults to 25.
+            sv (float, optional): Initial set value in C. Defaults to 25.
+            tau (float, optional): Time constant of the box in seconds. Defaults to 600.
+            ambient (float, optional): Ambient temperature in C. Defaults to 25.
+            speedup (float, optional): How much faster than real time the temperature evolves. Defaults to 1.
+        """
+        self.pv = pv
+        self.sv = sv
+        self.tau = tau
+        self.ambient = ambient
+        self.speedup = speedup
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def update(self) -> None:
+        now = time.monotonic()
+        dt = (now - self.updated)*self.speedup
+        self.updated = now
+        self.pv += (self.sv - self.pv)*(1 - math.exp(-dt/self.tau))
+
+
+    def output(self) -> float:
+        power = 2.*(self.sv - self.ambient) + 20.*(self.sv - self.pv)
+        return min(100., max(0., power))
+
+
+    def registers(self) -> dict:
+        with self.lock:
+            self.update()
+            return {
+                novus.REGISTER_SV: round(self.sv*10),
+                novus.REGISTER_PV: round(self.pv*10),
+                novus.REGISTER_OUTPUT: round(self.output()*10)}
+
+
+    def read(self, start:int, count:int) -> list:
+        registers = self.registers()
+        return [registers.get(r, 0) & 0xFFFF for r in range(start, start + count)]
+
+
+    def write(self, register:int, value:int) -> None:
+        with self.lock:
+            self.update()
+            if register == novus.REGISTER_SV:
+                self.sv = novus.to_signed(value)/10.
+
+
+class SimulatedBus(threading.Thread):
+    def __init__(self, addresses, latency:float=0., drop_rate:float=0., baudrate:int=9600, **device_options):
+        """RS485 bus of simulated controllers behind a pseudo-terminal, POSIX only
+
+        Open .port with pyserial or minimalmodbus as if it was a USB-RS485 adapter. Modbus RTU
+        functions 3, 4 (read registers), 6 and 16 (write registers) are answered.
+
+        Args:
+            addresses (iterable): Modbus addresses of the controllers on the bus
+            latency (float, optional): Extra response time in seconds of the controllers. Defaults to 0.
+            drop_rate (float, optional): Probability that a request gets no reply. Defaults to 0.
+            baudrate (int, optional): Emulated line speed, adds the transmission time of the frames. Defaults to 9600, 0 for none.
+            device_options: Keyword arguments of SimulatedN1050
+        """
+        super().__init__(name='simulated-bus', daemon=True)
+        self.devices = {address: SimulatedN1050(**device_options) for address in addresses}
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.baudrate = baudrate
+        self.requests = 0
+        self.dropped = 0
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+
+
+    def transmission_time(self, frame_bytes:int) -> float:
+        # 10 bits per byte: start, 8 data bits and stop
+        return frame_bytes*10./self.baudrate if self.baudrate else 0.
+
+
+    def respond(self, request:bytes) -> bytes:
+        """Response to a complete request frame, None when the request gets no reply"""
+        address, function = request[0], request[1]
+        device = self.devices.get(address)
+        if device is None:
+            return None
+        if function in (3, 4):
+            start, count = struct.unpack('>HH', request[2:6])
+            values = device.read(start, count)
+            return with_crc(bytes([address, function, 2*count]) + struct.pack(f'>{count}H', *values))
+        if function == 6:
+            register, value = struct.unpack('>HH', request[2:6])
+            device.write(register, value)
+            return with_crc(request[:6])
+        if function == 16:
+            start, count = struct.unpack('>HH', request[2:6])
+            values = struct.unpack(f'>{count}H', request[7:7+2*count])
+            for offset, value in enumerate(values):
+                device.write(start + offset, value)
+            return with_crc(request[:6])
+        # illegal function exception
+        return with_crc(bytes([address, function | 0x80, 1]))
+
+
+    @staticmethod
+    def frame_length(buffer:bytes) -> int:
+        """Length of the request frame at the start of the buffer, None if more bytes are needed to tell"""
+        if len(buffer) < 2:
+            return None
+        if buffer[1] == 16:
+            return 9 + buffer[6] if len(buffer) >= 7 else None
+        return 8
+
+
+    def run(self) -> None:
+        buffer = b''
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                # silence on the line ends any partial frame
+                buffer = b''
+                continue
+            try:
+                buffer += os.read(self.master, 256)
+            except OSError:
+                return
+            while True:
+                length = self.frame_length(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                request, buffer = buffer[:length], buffer[length:]
+                if crc16(request[:-2]) != struct.unpack('<H', request[-2:])[0]:
+                    buffer = b''
+                    break
+                self.requests += 1
+                response = self.respond(request)
+                if response is None:
+                    continue
+                if random.random() < self.drop_rate:
+                    self.dropped += 1
+                    continue
+                time.sleep(self.latency + self.transmission_time(len(request) + len(response)))
+                os.write(self.master, response)
+
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join(1.)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate Novus N1050 controllers on pseudo-terminals')
+    parser.add_argument('--buses', type=int, default=1, help='number of ports')
+    parser.add_argument('--boxes', type=int, default=1, help='number of controllers per port, at addresses 1, 2, ...')
+    parser.add_argument('--latency', type=float, default=0.01, help='response time in seconds of the controllers')
+    parser.add_argument('--drop-rate', type=float, default=0., help='probability that a request gets no reply')
+    parser.add_argument('--tau', type=float, default=600., help='time constant of the boxes in seconds')
+    parser.add_argument('--speedup', type=float, default=1., help='how much faster than real time the temperature evolves')
+    args = parser.parse_args()
+
+    buses = [SimulatedBus(range(1, args.boxes + 1), args.latency, args.drop_rate, tau=args.tau, speedup=args.speedup) for _ in range(args.buses)]
+    for bus in buses:
+        bus.start()
+        print(f'{bus.port}: addresses 1 to {args.boxes}')
+    try:
+        while True:
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        for bus in buses:
+            bus.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#Standard Library Imports
+import argparse
+import mmap
+import os
+import struct
+
+# numpy is only needed to memory-map the binary files for analysis
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+COLUMNS = ('timestamp', 'time_elapsed', 'pv', 'sv', 'output')
+
+
+class CsvBackend(object):
+    """Free-form text records, one comma separated line per datapoint
+
+    Files written before the output power was logged have no output column, the records appended
+    to them keep to the columns of their header, see .columns.
+    """
+    name = 'csv'
+    extension = '.csv'
+
+    FORMATS = {'timestamp':'{}', 'time_elapsed':'{}', 'pv':'{:.2f}', 'sv':'{:.2f}', 'output':'{:.1f}'}
+
+    def header(self) -> bytes:
+        return (', '.join(COLUMNS) + '\n').encode()
+
+    def encode(self, state:dict, columns:tuple=COLUMNS) -> bytes:
+        return (', '.join(self.FORMATS[c].format(state[c]) for c in columns) + '\n').encode()
+
+    def columns(self, f) -> tuple:
+        """Columns of the header of a file open for binary reading, COLUMNS if it has no header yet"""
+        f.seek(0)
+        line = f.readline()
+        if not line.endswith(b'\n'):
+            return COLUMNS
+        columns = tuple(c.strip() for c in line.decode().split(','))
+        return columns if set(columns) <= set(COLUMNS) else COLUMNS
+
+    def complete_size(self, f) -> int:
+        """Size of the complete lines at the start of a file open for binary reading"""
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+        return 0
+
+
+class BinaryBackend(object):
+    """Fixed-width little endian records in an append-only file
+
+    The file starts with a 16 byte header: the MAGIC bytes, the format version and the record size.
+    Each record is the float64 timestamp and time_elapsed followed by the float32 pv, sv and output,
+    so a whole run can be memory-mapped as a numpy structured array, see read_records.
+    """
+    name = 'binary'
+    extension = '.tbx'
+
+    MAGIC = b'TBOXRUN\0'
+    VERSION = 1
+    HEADER = struct.Struct('<8sII')
+    RECORD = struct.Struct('<ddfff')
+
+    def header(self) -> bytes:
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size)
+
+    def encode(self, state:dict, columns:tuple=COLUMNS) -> bytes:
+        return self.RECORD.pack(*(state[c] for c in COLUMNS))
+
+    def columns(self, f) -> tuple:
+        """Columns of the records of a file, always every one of them"""
+        return COLUMNS
+
+    def complete_size(self, f) -> int:
+        """Size of the header and complete records at the start of a file open for binary reading"""
+        size = f.seek(0, os.SEEK_END)
+        if size < self.HEADER.size:
+            return 0
+        return size - (size - self.HEADER.size) % self.RECORD.size
+
+
+BACKENDS = {backend.name: backend for backend in (CsvBackend, BinaryBackend)}
+
+
+def get_backend(name:str):
+    """Backend instance from its name in the "storage" setting
+
+    Args:
+        name (str): "csv" or "binary"
+    """
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f'unknown storage backend {name!r}, expected one of {sorted(BACKENDS)}')
+
+
+def _check_header(data) -> None:
+    magic, version, record_size = BinaryBackend.HEADER.unpack_from(data)
+    if magic != BinaryBackend.MAGIC:
+        raise ValueError('not a temperature box binary run file')
+    if version != BinaryBackend.VERSION or record_size != BinaryBackend.RECORD.size:
+        raise ValueError(f'unsupported binary run file version {version}')
+
+
+def record_dtype():
+    """numpy dtype of the records of a binary run file"""
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('time_elapsed', '<f8'),
+        ('pv', '<f4'),
+        ('sv', '<f4'),
+        ('output', '<f4')])
+
+
+def read_records(filepath:str):
+    """Memory-map the records of a binary run file
+
+    Args:
+        filepath (str): Path of the .tbx file
+
+    Returns:
+        numpy.memmap: Read-only structured array with one field per column
+    """
+    if np is None:
+        raise ImportError('numpy is required to memory-map binary run files')
+    with open(filepath, 'rb') as f:
+        _check_header(f.read(BinaryBackend.HEADER.size))
+    count = (os.path.getsize(filepath) - BinaryBackend.HEADER.size)//BinaryBackend.RECORD.size
+    if count == 0:
+        return np.zeros(0, dtype=record_dtype())
+    return np.memmap(filepath, dtype=record_dtype(), mode='r', offset=BinaryBackend.HEADER.size, shape=(count,))
+
+
+def iter_records(filepath:str):
+    """Iterate over the records of a binary run file without numpy
+
+    Args:
+        filepath (str): Path of the .tbx file
+
+    Yields:
+        dict: One record per datapoint, keyed by column
+    """
+    with open(filepath, 'rb') as f:
+        _check_header(f.read(BinaryBackend.HEADER.size))
+        size = os.fstat(f.fileno()).st_size
+        if size <= BinaryBackend.HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # a record cut short by a crash is ignored
+            end = size - (size - BinaryBackend.HEADER.size) % BinaryBackend.RECORD.size
+            for values in BinaryBackend.RECORD.iter_unpack(data[BinaryBackend.HEADER.size:end]):
+                yield dict(zip(COLUMNS, values))
+
+
+def export_csv(source:str, destination:str) -> int:
+    """Convert a binary run file to the CSV format written by the csv backend
+
+    Args:
+        source (str): Path of the .tbx file
+        destination (str): Path of the CSV file to create
+
+    Returns:
+        int: Number of records exported
+    """
+    csv = CsvBackend()
+    count = 0
+    with open(destination, 'wb') as f:
+        f.write(csv.header())
+        for record in iter_records(source):
+            f.write(csv.encode(record))
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tools for the binary run files of the temperature boxes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export = subparsers.add_parser('export', help='export a binary run file to CSV')
+    export.add_argument('source', help='.tbx run file')
+    export.add_argument('destination', nargs='?', help='CSV file, defaults to the source with a .csv extension')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        destination = args.destination or os.path.splitext(args.source)[0] + CsvBackend.extension
+        count = export_csv(args.source, destination)
+        print(f'exported {count} records to {destination}')
+
+
+if __name__ == "__main__":
+    main()
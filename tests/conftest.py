@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the application import each other from their own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'temperaturebox'))
@@ -0,0 +1,96 @@
+import math
+import random
+
+from catalog import Run
+from datalog import DataLogger, SwingingDoor
+
+
+def compress(points, deviation, max_gap):
+    door = SwingingDoor(deviation, max_gap)
+    stored = []
+    for point in points:
+        stored += door.offer(point)
+    return stored + door.flush()
+
+
+def random_run(seed, n=2000):
+    """Datapoints of a run with set value steps, a drifting PV and noise of a tenth of a degree"""
+    rng = random.Random(seed)
+    points = []
+    stamp, pv, sv = 0., 25., 25.
+    for _ in range(n):
+        stamp += rng.uniform(1, 30)
+        if rng.random() < 0.01:
+            sv = float(rng.randint(20, 60))
+        pv += (sv - pv)*0.02 + rng.gauss(0, 0.05)
+        points.append({'timestamp':stamp, 'pv':round(pv, 1), 'sv':sv})
+    return points
+
+
+def interpolate(stored, stamp):
+    for a, b in zip(stored, stored[1:]):
+        if a['timestamp'] <= stamp <= b['timestamp']:
+            if b['timestamp'] == a['timestamp']:
+                return a['pv']
+            return a['pv'] + (b['pv'] - a['pv'])*(stamp - a['timestamp'])/(b['timestamp'] - a['timestamp'])
+    raise AssertionError(f'{stamp} is outside of the stored points')
+
+
+def test_stored_points_interpolate_the_pv_within_the_deviation():
+    for seed in range(20):
+        points = random_run(seed)
+        stored = compress(points, 0.2, 600.)
+        assert len(stored) < len(points)
+        assert stored[0] == points[0] and stored[-1] == points[-1]
+        for point in points:
+            assert abs(interpolate(stored, point['timestamp']) - point['pv']) <= 0.2 + 1e-9
+
+
+def test_stored_points_are_datapoints_in_order():
+    points = random_run(1)
+    stored = compress(points, 0.5, 600.)
+    stamps = [p['timestamp'] for p in stored]
+    assert stamps == sorted(set(stamps))
+    assert all(p in points for p in stored)
+
+
+def test_set_value_changes_are_stored_with_the_point_before():
+    points = random_run(2)
+    stored = compress(points, 1., 1e9)
+    for before, after in zip(points, points[1:]):
+        if before['sv'] != after['sv']:
+            assert before in stored and after in stored
+
+
+def test_stored_points_are_at_most_max_gap_apart():
+    points = [{'timestamp':float(t), 'pv':30., 'sv':30.} for t in range(0, 10000, 10)]
+    stored = compress(points, 0.5, 300.)
+    gaps = [b['timestamp'] - a['timestamp'] for a, b in zip(stored, stored[1:])]
+    assert max(gaps) <= 300.
+    # a constant PV needs nothing but the gap points
+    assert len(stored) <= 10000/300 + 2
+
+
+def test_flush_stores_the_held_point_once():
+    door = SwingingDoor(0.5, 600.)
+    assert door.offer({'timestamp':0., 'pv':25., 'sv':25.}) == [{'timestamp':0., 'pv':25., 'sv':25.}]
+    assert door.offer({'timestamp':10., 'pv':25.1, 'sv':25.}) == []
+    assert door.flush() == [{'timestamp':10., 'pv':25.1, 'sv':25.}]
+    assert door.flush() == []
+
+
+def test_resumed_csv_run_keeps_the_columns_of_its_file(tmp_path):
+    filepath = str(tmp_path / 'run.csv')
+    # a file written before the output power was logged
+    with open(filepath, 'w') as f:
+        f.write('timestamp, time_elapsed, pv, sv\n1.0, 0.0, 25.00, 30.00\n')
+    logger = DataLogger()
+    logger.write_header(filepath)
+    logger.write_datapoint(filepath, {'timestamp':2., 'time_elapsed':1., 'pv':25.5, 'sv':30., 'output':50.})
+    logger.close()
+    with open(filepath) as f:
+        assert f.read().splitlines()[-1] == '2.0, 1.0, 25.50, 30.00'
+
+    records = Run({}, filepath + '.json').records()
+    assert list(records['pv']) == [25., 25.5]
+    assert all(math.isnan(output) for output in records['output'])
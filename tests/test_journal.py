@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from journal import Journal, fast_forward
+from protocol import Timeline, normalize
+
+
+PROTOCOL = normalize([
+    {'temperature':30, 'time':1},
+    {'type':'ramp', 'temperature':40, 'time':1},
+    {'type':'stable', 'temperature':40, 'tolerance':0.5, 'minutes':10},
+    {'temperature':25, 'time':2}])
+
+
+def box(step=1, at=1000.):
+    return {'protocol':PROTOCOL, 'state':{
+        'status':'running', 'basename':'run', 'filepath':'run.csv', 'start_timestamp':1000.,
+        'current_step':step, 'step_start_timestamp':at}}
+
+
+def run(step, at, status='running'):
+    return {'status':status, 'basename':'run', 'filepath':'run.csv', 'start_timestamp':1000., 'current_step':step, 'step_start_timestamp':at}
+
+
+def test_fold_tracks_the_last_run_of_every_box():
+    journal = Journal()
+    journal.start(0, box())
+    journal.start(1, box())
+    journal.step(0, 2, 4600.)
+    journal.stopped(1)
+    runs = journal.recover()
+    assert runs[0]['current_step'] == 2 and runs[0]['step_start_timestamp'] == 4600. and runs[0]['status'] == 'running'
+    assert runs[0]['protocol'] == PROTOCOL
+    assert runs[1]['status'] == 'stopped'
+    assert journal.running(0) and not journal.running(1) and not journal.running(2)
+
+
+def test_records_of_a_box_with_no_run_are_ignored():
+    journal = Journal()
+    journal.fold({'event':'step', 'box':3, 'step':2, 'at':0.})
+    journal.fold({'event':'done', 'box':3})
+    assert journal.runs == {}
+
+
+def test_recover_reads_the_snapshot_and_the_records_after_it(tmp_path):
+    filepath = str(tmp_path / 'settings.journal')
+    journal = Journal(filepath, compact_records=1000)
+    journal.recover()
+    journal.start(0, box())
+    journal.step(0, 2, 4600.)
+    journal.compact()
+    journal.step(0, 3, 8200.)
+    journal.start(1, box())
+    journal.done(1)
+    # a crash in the middle of a record
+    with open(filepath, 'a') as f:
+        f.write('{"event": "step", "box": 0, "st')
+
+    runs = Journal(filepath).recover()
+    assert runs[0]['current_step'] == 3 and runs[0]['step_start_timestamp'] == 8200.
+    assert runs[1]['status'] == 'done'
+    # recovering compacts the journal into one snapshot
+    with open(filepath) as f:
+        lines = f.readlines()
+    assert len(lines) == 1 and json.loads(lines[0])['event'] == 'snapshot'
+
+
+def test_journal_compacts_after_compact_records(tmp_path):
+    filepath = str(tmp_path / 'settings.journal')
+    journal = Journal(filepath, compact_records=5)
+    journal.recover()
+    journal.start(0, box())
+    for step in range(2, 10):
+        journal.step(0, step, 1000.*step)
+    with open(filepath) as f:
+        assert len(f.readlines()) <= 5
+    assert Journal(filepath).recover()[0]['current_step'] == 9
+
+
+def test_closed_journal_refuses_records(tmp_path):
+    journal = Journal(str(tmp_path / 'settings.journal'))
+    journal.recover()
+    journal.close()
+    with pytest.raises(ValueError):
+        journal.stopped(0)
+
+
+def test_fast_forward_skips_the_steps_which_ended():
+    timeline = Timeline.compile(PROTOCOL)
+    # still in the first hour
+    assert fast_forward(run(1, 1000.), timeline, 1000. + 1800) == run(1, 1000.)
+    # the hold and half the ramp went by, the ramp started when the hold ended
+    assert fast_forward(run(1, 1000.), timeline, 1000. + 5400) == run(2, 4600.)
+    # a stable step waits for readings, however long the application was down
+    assert fast_forward(run(1, 1000.), timeline, 1e9) == run(3, 8200.)
+    assert fast_forward(run(3, 9000.), timeline, 1e9) == run(3, 9000.)
+    # past the end of the last step
+    assert fast_forward(run(4, 9000.), timeline, 9000. + 7200)['status'] == 'done'
+    # only running runs move
+    assert fast_forward(run(1, 1000., 'stopped'), timeline, 1e9) == run(1, 1000., 'stopped')
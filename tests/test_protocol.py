@@ -0,0 +1,148 @@
+import math
+import random
+from bisect import bisect_right
+
+import pytest
+
+from protocol import Segment, Timeline, normalize, HOLD, RAMP, STABLE, REPEAT, RAMP_INTERVAL
+
+
+def unroll(protocol:list, ramp_interval:float=RAMP_INTERVAL) -> list:
+    """Segments of a protocol with its repeat blocks written out, the ramps with no 'from' starting at the previous temperature"""
+    segments = []
+    def walk(steps):
+        for p in steps:
+            kind = p.get('type', HOLD)
+            if kind == REPEAT:
+                for _ in range(p['count']):
+                    walk(p['steps'])
+            elif kind == RAMP:
+                start = p.get('from', segments[-1].temperature if segments else None)
+                segments.append(Segment(RAMP, p['temperature'], p['time']*3600, start=start, interval=p.get('interval', ramp_interval)))
+            elif kind == STABLE:
+                segments.append(Segment(STABLE, p['temperature'], p['minutes']*60, tolerance=p['tolerance']))
+            else:
+                segments.append(Segment(HOLD, p['temperature'], float('inf') if p['time'] < 0 else p['time']*3600))
+    walk(protocol)
+    return segments
+
+
+class Unrolled(object):
+    def __init__(self, protocol:list):
+        """Straightforward timeline over the unrolled segments, the reference of Timeline"""
+        self.segments = unroll(protocol)
+        self.starts = [0.]
+        for segment in self.segments:
+            self.starts.append(self.starts[-1] + segment.duration)
+        self.duration = self.starts.pop()
+
+    def index(self, offset):
+        if offset >= self.duration:
+            return len(self.segments)
+        return max(0, bisect_right(self.starts, offset) - 1)
+
+    def sv_at(self, offset):
+        k = self.index(offset)
+        if k == len(self.segments):
+            return None
+        return self.segments[k].sv_at(offset - self.starts[k])
+
+    def next_event(self, offset):
+        k = self.index(offset)
+        if k == len(self.segments):
+            return float('inf')
+        segment = self.segments[k]
+        return min(self.starts[k] + segment.next_push(offset - self.starts[k]), self.starts[k] + segment.duration)
+
+    def skip(self, k, elapsed):
+        if k >= len(self.segments) or self.segments[k].kind == STABLE:
+            return k
+        j = self.index(self.starts[k] + elapsed)
+        stable = [n for n in range(k + 1, len(self.segments)) if self.segments[n].kind == STABLE]
+        return min([j] + stable[:1])
+
+
+def random_step(rng, depth):
+    r = rng.random()
+    if r < 0.15 and depth < 3:
+        return {'type':'repeat', 'count':rng.randint(0, 4), 'steps':[random_step(rng, depth + 1) for _ in range(rng.randint(0, 3))]}
+    if r < 0.4:
+        return {'type':'ramp', 'temperature':rng.randint(0, 80), 'time':rng.choice([0, 0.5, 1, 2])}
+    if r < 0.55:
+        return {'type':'stable', 'temperature':rng.randint(0, 80), 'tolerance':0.5, 'minutes':rng.choice([0, 5, 10])}
+    return {'temperature':rng.randint(0, 80), 'time':rng.choice([0, 1, 2, -1] if rng.random() < 0.1 else [0, 1, 2])}
+
+
+def random_protocols(n, seed=1):
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield rng, normalize([{'temperature':20, 'time':1}] + [random_step(rng, 0) for _ in range(rng.randint(0, 4))])
+
+
+def close(a, b):
+    return a == b or (a is not None and b is not None and math.isclose(a, b, abs_tol=1e-6))
+
+
+def test_segments_match_the_unrolled_protocol():
+    for _, protocol in random_protocols(1000):
+        reference = Unrolled(protocol)
+        timeline = Timeline.compile(protocol)
+        assert len(timeline) == len(reference.segments)
+        assert close(timeline.duration, reference.duration)
+        for k, segment in enumerate(reference.segments):
+            assert timeline.segment(k) == segment
+            assert close(timeline.start(k), reference.starts[k])
+        assert close(timeline.start(len(timeline)), reference.duration)
+
+
+def test_lookups_match_the_unrolled_protocol():
+    for rng, protocol in random_protocols(1000):
+        reference = Unrolled(protocol)
+        timeline = Timeline.compile(protocol)
+        finite = [s for s in reference.starts if s != float('inf')]
+        end = reference.duration if reference.duration != float('inf') else max(finite) + 10000
+        # the boundaries of the segments, where the off by ones hide, and offsets in between
+        offsets = finite + [end, -10.] + [rng.uniform(0, end + 100) for _ in range(30)]
+        for offset in offsets:
+            assert timeline.index(offset) == reference.index(offset), (protocol, offset)
+            assert close(timeline.sv_at(offset), reference.sv_at(offset)), (protocol, offset)
+            assert close(timeline.next_event(offset), reference.next_event(offset)), (protocol, offset)
+        for _ in range(10):
+            k = rng.randrange(len(reference.segments) + 1)
+            elapsed = rng.choice([0., rng.uniform(0, end), 1e12])
+            assert timeline.skip(k, elapsed) == reference.skip(k, elapsed), (protocol, k, elapsed)
+
+
+def test_long_cycling_protocol_is_not_unrolled():
+    cycle = [
+        {'type':'ramp', 'temperature':60, 'time':2},
+        {'type':'stable', 'temperature':60, 'tolerance':0.5, 'minutes':10},
+        {'temperature':60, 'time':4},
+        {'type':'ramp', 'temperature':25, 'time':2},
+        {'temperature':25, 'time':4}]
+    timeline = Timeline.compile(normalize([{'temperature':25, 'time':1}, {'type':'repeat', 'count':1000000, 'steps':cycle}]))
+    period = (2 + 4 + 2 + 4)*3600 + 600
+    assert len(timeline) == 1 + 5*1000000
+    assert timeline.duration == 3600 + 1000000*period
+    last = 1 + 5*999999
+    assert timeline.segment(last) == Segment(RAMP, 60, 2*3600, start=25, interval=RAMP_INTERVAL)
+    assert timeline.start(last) == 3600 + 999999*period
+    assert timeline.index(timeline.duration - 1) == len(timeline) - 1
+    assert timeline.sv_at(3600 + 3600) == 42.5
+    # a skip stops at the next stable segment
+    assert timeline.skip(3, 1e12) == 7
+
+
+def test_ramp_starting_the_protocol_needs_a_from_temperature():
+    with pytest.raises(ValueError):
+        Timeline.compile(normalize([{'type':'ramp', 'temperature':30, 'time':1}]))
+    timeline = Timeline.compile(normalize([{'type':'ramp', 'temperature':30, 'time':1, 'from':20}]))
+    assert timeline.sv_at(1800) == 25
+
+
+def test_empty_repeat_blocks_have_no_segments():
+    protocol = normalize([{'temperature':20, 'time':1}, {'type':'repeat', 'count':0, 'steps':[{'temperature':30, 'time':1}]},
+                          {'type':'repeat', 'count':3, 'steps':[]}, {'temperature':40, 'time':1}])
+    timeline = Timeline.compile(protocol)
+    assert len(timeline) == 2
+    assert timeline.segment(1) == Segment(HOLD, 40, 3600)
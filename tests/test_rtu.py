@@ -0,0 +1,56 @@
+import struct
+
+import minimalmodbus
+import pytest
+
+from rtu import crc16, with_crc, check_frame, response_length
+
+
+REQUEST = with_crc(bytes.fromhex('010300000003'))
+
+
+def test_crc16_of_known_frames():
+    # read 10 holding registers from address 1, as given in the Modbus over serial line specification
+    assert with_crc(bytes.fromhex('01030000000a')) == bytes.fromhex('01030000000ac5cd')
+    assert crc16(b'') == 0xFFFF
+    # the CRC of a frame followed by its CRC is 0
+    assert crc16(REQUEST) == 0
+
+
+def test_check_frame_returns_the_payload():
+    response = with_crc(bytes.fromhex('010306') + struct.pack('>3H', 250, 251, 0))
+    assert check_frame(REQUEST, response) == bytes.fromhex('06') + struct.pack('>3H', 250, 251, 0)
+
+
+def test_check_frame_rejects_a_corrupted_frame():
+    response = bytearray(with_crc(bytes.fromhex('01030600fa00fb0000')))
+    response[4] ^= 0x01
+    with pytest.raises(minimalmodbus.InvalidResponseError):
+        check_frame(REQUEST, bytes(response))
+
+
+def test_check_frame_rejects_another_address_or_function():
+    with pytest.raises(minimalmodbus.InvalidResponseError):
+        check_frame(REQUEST, with_crc(bytes.fromhex('02030600fa00fb0000')))
+    with pytest.raises(minimalmodbus.InvalidResponseError):
+        check_frame(REQUEST, with_crc(bytes.fromhex('01040600fa00fb0000')))
+
+
+@pytest.mark.parametrize('code, error', [
+    (1, minimalmodbus.IllegalRequestError),
+    (2, minimalmodbus.IllegalRequestError),
+    (3, minimalmodbus.IllegalRequestError),
+    (6, minimalmodbus.SlaveDeviceBusyError),
+    (4, minimalmodbus.SlaveReportedException)])
+def test_check_frame_raises_the_exception_codes(code, error):
+    with pytest.raises(error):
+        check_frame(REQUEST, with_crc(bytes([1, 0x83, code])))
+
+
+def test_response_length():
+    read = response_length(REQUEST)
+    assert read(bytes.fromhex('0103')) is None
+    assert read(bytes.fromhex('010306')) == 11
+    assert read(bytes.fromhex('018302')) == 5
+    write = response_length(with_crc(bytes.fromhex('011000000001020190')))
+    assert write(bytes.fromhex('011000')) == 8